@@ -0,0 +1,96 @@
+import os
+
+import numpy as np
+import torch
+
+from .u2net import detect
+
+BACKENDS = ("torch", "onnx")
+
+
+def onnx_path(model_name):
+    """Default location of the exported ONNX model, next to the ``.pth`` weights."""
+    return os.path.splitext(detect.model_path(model_name))[0] + ".onnx"
+
+
+def export_onnx(model_name="u2net", path=None, opset_version=17):
+    """Export ``model_name`` to ONNX with dynamic batch and spatial dimensions.
+
+    The graph has a single ``input`` (N x 3 x H x W, normalized like
+    ``detect.preprocess_image``) and a single ``mask`` output holding the
+    fused saliency map. Returns the path written.
+    """
+    path = path or onnx_path(model_name)
+    net = detect.load_model(model_name, device="cpu", inference_only=True)
+    dummy = torch.zeros(1, 3, 320, 320)
+    dynamic_axes = {
+        "input": {0: "batch", 2: "height", 3: "width"},
+        "mask": {0: "batch", 2: "height", 3: "width"},
+    }
+    kwargs = dict(
+        input_names=["input"],
+        output_names=["mask"],
+        dynamic_axes=dynamic_axes,
+        opset_version=opset_version,
+    )
+
+    def export(tmp):
+        with torch.no_grad():
+            try:
+                torch.onnx.export(net, dummy, tmp, dynamo=False, **kwargs)
+            except TypeError:  # torch < 2.5 has no dynamo switch
+                torch.onnx.export(net, dummy, tmp, **kwargs)
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    print(f"exporting {model_name} to {path} ...")
+    # readers only ever see a complete file, even while another process exports
+    detect.save_atomic(path, export)
+    return path
+
+
+class OnnxModel(torch.nn.Module):
+    """onnxruntime session that can stand in for a U2NET model.
+
+    Calls take and return torch tensors, and the output is a one-element
+    tuple like an ``inference_only`` U2NET, so ``detect.predict`` and
+    ``bg.Net`` work with either backend. It cannot be traced with
+    ``torch.jit.trace``.
+    """
+
+    def __init__(self, path, num_threads=None):
+        super(OnnxModel, self).__init__()
+        try:
+            import onnxruntime as ort
+        except ImportError:
+            raise ImportError(
+                "The onnx backend needs onnxruntime, install it with `pip install onnxruntime`"
+            )
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.path = path
+        self.session = ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def forward(self, x):
+        x = np.ascontiguousarray(x.detach().to(device="cpu", dtype=torch.float32).numpy())
+        out = self.session.run(None, {self.input_name: x})[0]
+        return (torch.from_numpy(out),)
+
+
+def ensure_onnx(model_name="u2net"):
+    """Path of the ONNX model for ``model_name``, exported first if missing or older than the weights."""
+    path = onnx_path(model_name)
+    weights = detect.model_path(model_name)
+    if not os.path.exists(path) or (
+        os.path.exists(weights) and os.path.getmtime(weights) > os.path.getmtime(path)
+    ):
+        export_onnx(model_name, path)
+    return path
+
+
+def load_onnx(model_name="u2net"):
+    """Load the ONNX model for ``model_name``, exporting it on first use."""
+    return OnnxModel(ensure_onnx(model_name))
@@ -0,0 +1,653 @@
+"""
+Micro-benchmarks for the inference pipeline.
+
+Run with ``python -m backgroundremover.benchmark <name>``; every benchmark
+works on synthetic data so it can be run without sample files.
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+from PIL import Image, ImageFilter
+
+
+def synthetic_image(height, width, seed=0):
+    """Smooth random colour field with a bright rectangular subject."""
+    rng = np.random.default_rng(seed)
+    small = rng.integers(0, 256, size=(max(height // 64, 2), max(width // 64, 2), 3), dtype=np.uint8)
+    img = np.array(Image.fromarray(small).resize((width, height), Image.BILINEAR))
+    img[height // 4:3 * height // 4, width // 3:2 * width // 3] = (240, 200, 180)
+    return img
+
+
+def synthetic_matte(height, width, seed=0):
+    """A subject with a wavy, anti-aliased outline over a darker textured background.
+
+    Returns the composited RGB image and its ground truth alpha as float32
+    in [0, 1], for judging masks and mattes against a known answer.
+    """
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    cy, cx, radius = height / 2, width / 2, min(height, width) / 3
+    theta = np.arctan2(y - cy, x - cx)
+    outline = radius * (1 + 0.12 * np.sin(5 * theta) + 0.05 * np.sin(17 * theta + 1))
+    # one pixel of anti-aliasing across the outline
+    alpha = np.clip(outline - np.hypot(y - cy, x - cx) + 0.5, 0, 1)
+    foreground = synthetic_image(height, width, seed=seed).astype(np.float32)
+    background = synthetic_image(height, width, seed=seed + 1)[:, ::-1].astype(np.float32) * 0.5
+    noise = rng.normal(0, 6, size=(height, width, 1)).astype(np.float32)
+    image = foreground * alpha[..., None] + background * (1 - alpha[..., None]) + noise
+    return np.clip(image, 0, 255).astype(np.uint8), alpha
+
+
+def timeit(fn, repeat):
+    """Best wall time of ``repeat`` calls to ``fn`` and the last result."""
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def bench_preprocess(args):
+    from .u2net import detect
+
+    img = synthetic_image(args.height, args.width)
+    old_time, old = timeit(lambda: detect.preprocess(img)["image"].numpy(), args.repeat)
+    new_time, new = timeit(lambda: detect.preprocess_image(img).numpy(), args.repeat)
+    diff = np.abs(old - new)
+
+    print(f"image: {args.width}x{args.height}")
+    print(f"RescaleT + ToTensorLab: {old_time * 1000:.1f} ms")
+    print(f"preprocess_image:       {new_time * 1000:.1f} ms ({old_time / new_time:.1f}x)")
+    print(f"max abs diff: {diff.max():.4f}  mean abs diff: {diff.mean():.5f}")
+
+
+def bench_heads(args):
+    import torch
+    from .u2net import u2net
+
+    torch.manual_seed(0)
+    inputs = torch.rand(args.batch, 3, args.size, args.size)
+    for cls in (u2net.U2NETP, u2net.U2NET):
+        net = cls(3, 1).eval()
+        with torch.no_grad():
+            full_time, full = timeit(lambda: net(inputs)[0], args.repeat)
+            net.inference_only = True
+            fast_time, fast = timeit(lambda: net(inputs)[0], args.repeat)
+        identical = torch.equal(full, fast)
+        print(f"{cls.__name__}: all heads {full_time * 1000:.1f} ms, "
+              f"inference_only {fast_time * 1000:.1f} ms, bit-identical: {identical}")
+        if not identical:
+            raise SystemExit(1)
+
+
+def bench_quantize(args):
+    from . import registry
+    from .u2net import detect
+
+    images = [synthetic_image(args.height, args.width, seed=i) for i in range(args.count)]
+    fp32 = registry.get_model(args.model, device="cpu")
+    int8 = registry.get_model(args.model, dtype="int8")
+
+    def run(net):
+        return [np.asarray(detect.predict(net, img).convert("L")) > 127 for img in images]
+
+    run(int8)  # warm up oneDNN/fbgemm kernels
+    fp32_time, fp32_masks = timeit(lambda: run(fp32), args.repeat)
+    int8_time, int8_masks = timeit(lambda: run(int8), args.repeat)
+
+    ious = []
+    for a, b in zip(fp32_masks, int8_masks):
+        union = np.logical_or(a, b).sum()
+        ious.append(np.logical_and(a, b).sum() / union if union else 1.0)
+
+    print(f"model: {args.model}, {args.count} images of {args.width}x{args.height}")
+    print(f"fp32: {args.count / fp32_time:.2f} images/s")
+    print(f"int8: {args.count / int8_time:.2f} images/s ({fp32_time / int8_time:.1f}x)")
+    print(f"mask IoU vs fp32: mean {np.mean(ious):.4f}, min {np.min(ious):.4f}")
+
+
+def bench_fold(args):
+    import copy
+    import torch
+    from .u2net import optimize, u2net
+
+    torch.manual_seed(0)
+    inputs = torch.rand(args.batch, 3, args.size, args.size)
+    for cls in (u2net.U2NETP, u2net.U2NET):
+        net = cls(3, 1, inference_only=True)
+        # give batch norm non-trivial statistics so folding actually changes the weights
+        for module in net.modules():
+            if isinstance(module, torch.nn.BatchNorm2d):
+                module.running_mean.uniform_(-0.5, 0.5)
+                module.running_var.uniform_(0.5, 2.0)
+                module.weight.data.uniform_(0.5, 1.5)
+                module.bias.data.uniform_(-0.5, 0.5)
+        net.eval()
+        fast = optimize.optimize_for_inference(copy.deepcopy(net))
+        fast_inputs = inputs.contiguous(memory_format=torch.channels_last) if fast.channels_last else inputs
+
+        with torch.no_grad():
+            base_time, base = timeit(lambda: net(inputs)[0], args.repeat)
+            fast_time, out = timeit(lambda: fast(fast_inputs)[0], args.repeat)
+        diff = (base - out).abs().max().item()
+        print(f"{cls.__name__}: eager {base_time * 1000:.1f} ms, folded+channels_last "
+              f"{fast_time * 1000:.1f} ms ({base_time / fast_time:.2f}x), max abs diff {diff:.2e}")
+        if diff > 1e-3:
+            raise SystemExit(1)
+
+
+def bench_decode(args):
+    import io
+    from . import bg
+    from .u2net import detect
+
+    for mp in args.megapixels:
+        width = int((mp * 1e6 * 4 / 3) ** 0.5)
+        height = int(width * 3 / 4)
+        bio = io.BytesIO()
+        Image.fromarray(synthetic_image(height, width)).save(bio, "JPEG", quality=90)
+        data = bio.getvalue()
+
+        full_time, full = timeit(lambda: detect.preprocess_image(
+            np.array(bg._open_image(data, "")), args.size), args.repeat)
+        draft_time, draft = timeit(lambda: detect.preprocess_image(
+            np.array(bg._open_draft(data, args.size)), args.size), args.repeat)
+        diff = (full - draft).abs().mean().item()
+        print(f"{mp:g} MP ({width}x{height}): full decode {full_time * 1000:.0f} ms, draft "
+              f"{draft_time * 1000:.0f} ms ({full_time / draft_time:.1f}x), mean abs input diff {diff:.4f}")
+
+
+def bench_frames(args):
+    import tempfile
+    from .framesource import FrameSource
+
+    with tempfile.TemporaryDirectory() as tmp:
+        clip = os.path.join(tmp, "clip.mp4")
+        subprocess.run(["ffmpeg", "-v", "error", "-y", "-f", "lavfi", "-i",
+                        f"testsrc2=size={args.width}x{args.width * 9 // 16}:rate=25", "-frames:v", str(args.frames),
+                        "-pix_fmt", "yuv420p", clip], check=True)
+
+        def read_into(threads):
+            source = FrameSource(clip, args.size, threads=threads)
+            buffer = np.empty(source.shape, dtype=np.uint8)
+            frames = 0
+            while source.read(buffer) is not None:
+                frames += 1
+            source.close()
+            return frames
+
+        results = {}
+        try:
+            from moviepy import VideoFileClip
+
+            def moviepy_frames():
+                return np.stack(list(VideoFileClip(clip).resized(height=args.size).iter_frames(dtype="uint8")))
+            results["moviepy"] = timeit(moviepy_frames, args.repeat)
+        except ImportError:
+            print("moviepy is not installed, skipping it")
+        results["ffmpeg"] = timeit(lambda: np.stack(list(FrameSource(clip, args.size))), args.repeat)
+        for threads in args.threads:
+            results[f"ffmpeg into one buffer, {threads or 'auto'} threads"] = \
+                timeit(lambda: read_into(threads), args.repeat)
+
+    reference = results.get("moviepy", results["ffmpeg"])[1]
+    for name, (seconds, frames) in results.items():
+        count = len(frames) if isinstance(frames, np.ndarray) else frames
+        line = f"{name:37s} {seconds * 1000 / count:6.2f} ms per frame ({count} frames)"
+        if isinstance(frames, np.ndarray) and frames is not reference and len(frames) == len(reference):
+            line += f", mean abs diff from moviepy {np.abs(frames.astype(np.int16) - reference).mean():.2f}"
+        print(line)
+
+
+def bench_composite(args):
+    import tracemalloc
+
+    from . import compositing
+
+    img = synthetic_image(args.height, args.width)
+    background_img = synthetic_image(args.height // 2, args.width // 2, seed=1)
+    mask = Image.fromarray(synthetic_image(320, 320, seed=2)[..., 0])
+
+    def pil_chain(background, threshold):
+        # the post-inference chain remove() used before the fused stage
+        image = Image.fromarray(img)
+        m = mask if threshold is None else mask.point(lambda p: 255 if p > threshold else 0)
+        cutout = Image.composite(image, Image.new("RGBA", image.size, 0), m.resize(image.size, Image.LANCZOS))
+        if background is None:
+            return np.asarray(cutout)
+        if isinstance(background, tuple):
+            bg = Image.new("RGB", cutout.size, background)
+        else:
+            bg = Image.fromarray(background).resize(cutout.size, Image.LANCZOS)
+        bg.paste(cutout, mask=cutout.split()[3])
+        return np.asarray(bg)
+
+    def staged(background, threshold, blend):
+        alpha = compositing.upscale_mask(mask, (args.width, args.height), threshold)
+        if isinstance(background, np.ndarray):
+            background = np.asarray(Image.fromarray(background).resize((args.width, args.height), Image.LANCZOS))
+        return blend(img, alpha, background)
+
+    failed = False
+    for name, background, threshold in [
+        ("transparent", None, None),
+        ("transparent + threshold", None, 128),
+        ("background colour", (0, 255, 0), None),
+        ("background image", background_img, None),
+    ]:
+        old_time, old = timeit(lambda: pil_chain(background, threshold), args.repeat)
+        new_time, new = timeit(lambda: staged(background, threshold, compositing.composite), args.repeat)
+        alpha = compositing.upscale_mask(mask, (args.width, args.height), threshold)
+        if isinstance(background, np.ndarray):
+            background = np.asarray(Image.fromarray(background).resize((args.width, args.height), Image.LANCZOS))
+        tracemalloc.start()
+        result = compositing.composite(img, alpha, background)
+        # everything NumPy allocated beyond the result itself
+        scratch = tracemalloc.get_traced_memory()[1] - result.nbytes
+        tracemalloc.stop()
+        diff = np.abs(old.astype(np.int16) - new).max()
+        print(f"{name:24s} PIL chain {old_time * 1000:7.1f} ms, composite {new_time * 1000:7.1f} ms "
+              f"({old_time / new_time:.2f}x, {scratch / 2 ** 20:.1f} MB scratch, max diff {diff})")
+        failed = failed or diff > 0
+    if failed:
+        raise SystemExit(1)
+
+
+def bench_upsample(args):
+    from . import upsample
+
+    print(f"{'method':10s}" + "".join(f"{size:>32s}" for size in args.sizes))
+    cases = []
+    for size in args.sizes:
+        width, height = (int(v) for v in size.split("x"))
+        image, truth = synthetic_matte(height, width)
+        # a soft model-resolution prediction of the true alpha
+        low = Image.fromarray((truth * 255).astype(np.uint8)).resize((args.size, args.size), Image.BOX)
+        mask = np.asarray(low.filter(ImageFilter.GaussianBlur(args.blur)), dtype=np.float32) / 255
+        edges = np.asarray(Image.fromarray(((truth > 0) & (truth < 1)).astype(np.uint8) * 255)
+                           .filter(ImageFilter.MaxFilter(2 * (width // args.size) + 1))) > 0
+        cases.append((image, truth, mask, edges))
+
+    for method in upsample.MASK_UPSAMPLERS:
+        row = f"{method:10s}"
+        for image, truth, mask, edges in cases:
+            height, width = truth.shape
+            elapsed, alpha = timeit(
+                lambda: upsample.upsample_mask(mask, (width, height), method, guide=image), args.repeat)
+            error = np.abs(alpha / 255 - truth) * 255
+            row += f"{elapsed * 1000:9.1f} ms  MAE {error.mean():5.2f}  edge {error[edges].mean():5.1f}"
+        print(row)
+    print("MAE is the mean absolute alpha error in 0-255 levels, edge the same within a few model pixels of the outline")
+
+
+def bench_matting(args):
+    import tracemalloc
+    from . import matting
+
+    def solve(engine, image, mask, trimap):
+        if engine == "cf-full":
+            # closed-form matting of the whole image, as before it was cropped to the unknown band
+            from pymatting.alpha.estimate_alpha_cf import estimate_alpha_cf
+            from pymatting.foreground.estimate_foreground_ml import estimate_foreground_ml
+
+            alpha = estimate_alpha_cf(image, trimap / 255.0)
+            return estimate_foreground_ml(image, alpha), alpha
+        return matting.estimate(image, mask, trimap, engine, max(args.erode // 2, 1), args.workers)
+
+    # compile pymatting's numba kernels before anything is measured
+    image, truth = synthetic_matte(48, 64)
+    mask = (truth * 255).astype(np.uint8)
+    for engine in args.engines:
+        solve(engine, image / 255.0, mask, matting.trimap(mask, 240, 10, 3))
+
+    print(f"{'size':>10s} {'engine':8s} {'time':>9s} {'peak':>9s} {'unknown':>8s}  alpha error (unknown / all)")
+    for size in args.sizes:
+        height, width = size * 3 // 4, size
+        image, truth = synthetic_matte(height, width)
+        # the model mask at 320 and scaled up, as alpha_matting_cutout gets it
+        low = Image.fromarray((truth * 255).astype(np.uint8)).resize((320, 320), Image.BOX)
+        mask = np.asarray(low.filter(ImageFilter.GaussianBlur(args.blur)).resize((width, height), Image.LANCZOS))
+        trimap = matting.trimap(mask, 240, 10, args.erode)
+        unknown = trimap == 128
+        full = None
+        for engine in args.engines:
+            tracemalloc.start()
+            elapsed, (_, alpha) = timeit(lambda: solve(engine, image / 255.0, mask, trimap), args.repeat)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            error = np.abs(alpha - truth) * 255
+            line = (f"{width:>5d}x{height:<4d} {engine:8s} {elapsed * 1000:7.0f} ms {peak / 2 ** 20:6.0f} MB "
+                    f"{unknown.mean():7.1%}  {error[unknown].mean():5.1f} / {error.mean():4.2f}")
+            if engine == "cf-full":
+                full = alpha
+            elif engine == "cf" and full is not None:
+                line += f"  (max diff to cf-full {np.abs(alpha - full).max() * 255:.2f})"
+            print(line)
+    print("peak is the most memory allocated at once by this process (tracemalloc); cf's incomplete "
+          "Cholesky preconditioner reserves about 4 GB up front, most of it never touched")
+
+
+def _tiles_case(args):
+    # one configuration in this process, so its peak RSS and its workers' are its own
+    import resource
+    from . import bg, matting
+
+    image = Image.fromarray(np.load(os.path.join(args.case_dir, "image.npy")))
+    mask = Image.open(os.path.join(args.case_dir, "mask.png"))
+    base_size, erode, memory = 1000, args.erode, None
+    if args.case == "full":
+        # what tiled matting solves, in one piece
+        base_size, erode = max(image.size), round(args.erode * max(image.size) / 1000)
+    elif args.case == "tiled":
+        memory = args.memory
+    start = time.perf_counter()
+    cutout = bg.alpha_matting_cutout(image, mask, 240, 10, erode, base_size, args.engine, memory, args.workers)
+    elapsed = time.perf_counter() - start
+    cutout.getchannel("A").save(os.path.join(args.case_dir, f"{args.engine}-{args.case}.png"))
+
+    tile, workers = matting.tile_plan(image.size[::-1], args.engine, matting.parse_memory(args.memory), args.workers)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    # with one worker tiles are solved in this process
+    worker = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024 if workers > 1 else 0
+    print(elapsed, peak, worker, tile, workers)
+
+
+def bench_tiles(args):
+    if args.case:
+        return _tiles_case(args)
+    import tempfile
+    from . import matting
+
+    height, width = args.size * 3 // 4, args.size
+    print(f"{width}x{height}, budget {args.memory}")
+    print(f"{'engine':8s} {'mode':6s} {'time':>8s} {'peak RSS':>9s} {'worker':>9s}  "
+          f"edge error")
+    with tempfile.TemporaryDirectory() as case_dir:
+        # generated once and handed over in files, so building it does not count towards the peak
+        image, truth = synthetic_matte(height, width)
+        low = Image.fromarray((truth * 255).astype(np.uint8)).resize((320, 320), Image.BOX)
+        low.filter(ImageFilter.GaussianBlur(args.blur)).save(os.path.join(case_dir, "mask.png"))
+        np.save(os.path.join(case_dir, "image.npy"), image)
+        del image
+        edge = (truth > 0) & (truth < 1)
+
+        for engine in args.engines:
+            alphas = {}
+            for case in args.modes:
+                command = [sys.executable, "-m", "backgroundremover.benchmark", "tiles", "--case", case,
+                           "--case-dir", case_dir, "--engine", engine, "--memory", args.memory,
+                           "--erode", str(args.erode), "--workers", str(args.workers)]
+                out = subprocess.run(command, capture_output=True, text=True, check=True).stdout
+                elapsed, peak, worker, tile, workers = map(float, out.split()[-5:])
+                alpha = np.asarray(Image.open(os.path.join(case_dir, f"{engine}-{case}.png")), dtype=np.float32)
+                alphas[case] = alpha
+                line = (f"{engine:8s} {case:6s} {elapsed:6.1f} s {peak / 2 ** 30:6.2f} GB "
+                        f"{worker / 2 ** 30 if case == 'tiled' else 0:6.2f} GB  "
+                        f"{np.abs(alpha - truth * 255)[edge].mean():10.1f}")
+                if case == "tiled":
+                    line = line.rstrip() + f"  ({int(tile)} px tiles, {int(workers)} workers)"
+                print(line)
+            if "tiled" in alphas and "full" in alphas:
+                # pixels of the unknown band within the overlap of a tile border, where windows are blended
+                tile = int(matting.tile_plan((height, width), engine, matting.parse_memory(args.memory))[0])
+                y, x = np.ogrid[0:height, 0:width]
+                near = lambda v: np.abs((v + tile // 2) % tile - tile // 2) < matting.TILE_OVERLAP
+                band = (alphas["full"] > 0) & (alphas["full"] < 255)
+                seam = band & (near(y) | near(x))
+                diff = np.abs(alphas["tiled"] - alphas["full"])
+                if not seam.any():
+                    print(f"{engine:8s} tiled vs full: one tile, max {diff.max():.0f} levels")
+                    continue
+                print(f"{engine:8s} tiled vs full: mean {diff[seam].mean():.2f} / {diff[band & ~seam].mean():.2f}, "
+                      f"max {diff[seam].max():.0f} / {diff[band & ~seam].max():.0f} levels at seams / elsewhere")
+    print("base mattes at -az 1000 and scales up, full mattes the whole image at full resolution, tiled "
+          "does the same in tiles with -amm; edge error is the mean alpha error in 0-255 levels on the "
+          "anti-aliased outline. Peak RSS includes the imported libraries; worker is the largest RSS of "
+          "one matting process")
+
+
+def bench_encode(args):
+    from . import bg, compositing
+
+    img = synthetic_image(args.height, args.width)
+    # sensor-like noise, a flat synthetic image compresses unrealistically well
+    noise = np.random.default_rng(0).integers(-8, 9, size=img.shape)
+    img = np.clip(img + noise, 0, 255).astype(np.uint8)
+    mask = np.zeros((args.height, args.width), dtype=np.uint8)
+    mask[args.height // 4:3 * args.height // 4, args.width // 3:2 * args.width // 3] = 255
+    cutout = Image.fromarray(compositing.composite(img, mask))
+
+    options = [
+        ("png level 6 (default)", dict(output_format="png", compress_level=6)),
+        ("png level 1", dict(output_format="png", compress_level=1)),
+        ("png level 0", dict(output_format="png", compress_level=0)),
+        ("webp lossless", dict(output_format="webp")),
+        ("webp quality 90", dict(output_format="webp", quality=90)),
+        ("raw", dict(output_format="raw")),
+    ]
+    for name, kwargs in options:
+        elapsed, data = timeit(lambda: bg.encode(cutout, **kwargs), args.repeat)
+        print(f"{name:22s} {elapsed * 1000:8.1f} ms {len(data) / 1e6:8.2f} MB")
+
+
+# optional heavy dependencies that importing the library must not pull in
+DEFERRED_MODULES = ("pymatting", "numba", "moviepy", "scipy.ndimage", "skimage", "torchvision", "hsh")
+
+PIPELINE_PROBE = """
+import time
+from backgroundremover import utilities
+if __name__ == "__main__":
+    start = time.perf_counter()
+    utilities.matte_key({output!r}, {clip!r}, {workers}, {batch}, "u2netp", frame_limit={frames},
+                        inference_size={size}, backend="onnx")
+    print(time.perf_counter() - start)
+"""
+
+# the same decode, model and encode in one process, one after the other
+SERIAL_PROBE = """
+import subprocess, time
+import numpy as np
+from backgroundremover.bg import Net, iter_frames, remove_many
+start = time.perf_counter()
+net = Net("u2netp", {size}, backend="onnx")
+frames = [frame for _, frame in zip(range({frames}), iter_frames({clip!r}, {size}))]
+proc = None
+for i in range(0, len(frames), {batch}):
+    masks = remove_many(frames[i:i + {batch}], net)
+    if proc is None:
+        proc = subprocess.Popen(["ffmpeg", "-y", "-f", "rawvideo", "-vcodec", "rawvideo", "-s",
+                                 "{{}}x{{}}".format(masks.shape[2], masks.shape[1]), "-pix_fmt", "gray", "-r", "25",
+                                 "-i", "-", "-an", "-vcodec", "mpeg4", "-b:v", "2000k", {output!r}],
+                                stdin=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    proc.stdin.write(masks.tobytes())
+proc.stdin.close()
+proc.wait()
+print(time.perf_counter() - start)
+"""
+
+
+def bench_pipeline(args):
+    import tempfile
+    import torch
+
+    with tempfile.TemporaryDirectory() as tmp:
+        clip, output = os.path.join(tmp, "clip.mp4"), os.path.join(tmp, "matte.mp4")
+        subprocess.run(["ffmpeg", "-v", "error", "-y", "-f", "lavfi", "-i", "testsrc2=size=320x240:rate=25",
+                        "-frames:v", str(max(args.frames)), "-pix_fmt", "yuv420p", clip], check=True)
+        # a one-layer stand-in for the model through the onnx backend, so
+        # that what is measured is decoding, encoding and the hand-offs
+        # between the processes rather than inference
+        env = dict(os.environ, U2NETP_PATH=os.path.join(tmp, "u2netp.pth"))
+        torch.onnx.export(torch.nn.Conv2d(3, 1, 1), torch.zeros(1, 3, args.size, args.size),
+                          os.path.join(tmp, "u2netp.onnx"), input_names=["input"], output_names=["mask"],
+                          dynamic_axes={"input": {0: "batch"}, "mask": {0: "batch"}})
+
+        def run(probe, frames):
+            code = probe.format(output=output, clip=clip, workers=args.workers, batch=args.batch,
+                                frames=frames, size=args.size)
+            out = subprocess.run([sys.executable, "-c", code], env=env, check=True, capture_output=True, text=True)
+            return float(out.stdout.split()[-1])
+
+        times = {}
+        for name, probe in (("pipeline", PIPELINE_PROBE), ("serial", SERIAL_PROBE)):
+            times[name] = [min(run(probe, n) for _ in range(args.repeat)) for n in args.frames]
+
+    short, long = args.frames
+    batches = (long - short) / args.batch
+    slope = {name: (t[1] - t[0]) / batches for name, t in times.items()}
+    for name, t in times.items():
+        print(f"{name:8s}: {short} frames {t[0]:.2f} s, {long} frames {t[1]:.2f} s, "
+              f"{slope[name] * 1000:.1f} ms per batch of {args.batch}")
+    overhead = slope["pipeline"] - slope["serial"]
+    print(f"pipeline overhead per batch: {overhead * 1000:.1f} ms (budget {args.budget * 1000:.0f} ms); "
+          f"the {short} frame clip takes {times['pipeline'][0] - times['serial'][0]:.2f} s longer than serial, "
+          f"which is starting {args.workers + 1} processes")
+    if overhead > args.budget:
+        raise SystemExit(1)
+
+
+IMPORT_PROBE = """
+import sys, time
+start = time.perf_counter()
+import {module}
+print(time.perf_counter() - start)
+print(",".join(m for m in {deferred!r} if m in sys.modules))
+"""
+
+
+def bench_startup(args):
+    failed = False
+    for module in args.modules:
+        best = float("inf")
+        for _ in range(args.repeat):
+            # a fresh interpreter per run, the import cache would hide everything otherwise
+            out = subprocess.run(
+                [sys.executable, "-c", IMPORT_PROBE.format(module=module, deferred=DEFERRED_MODULES)],
+                check=True, capture_output=True, text=True,
+            ).stdout.splitlines()
+            best = min(best, float(out[0]))
+        loaded = out[1] if len(out) > 1 else ""
+        print(f"import {module}: {best * 1000:.0f} ms" + (f", eagerly loads {loaded}" if loaded else ""))
+        if loaded or (args.budget and best > args.budget):
+            failed = True
+    if failed:
+        raise SystemExit(1)
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    sub = ap.add_subparsers(dest="benchmark")
+    sub.required = True
+
+    p = sub.add_parser("preprocess", help="Model input preprocessing, old vs vectorized.")
+    p.add_argument("--width", default=6000, type=int)
+    p.add_argument("--height", default=4000, type=int)
+    p.add_argument("--repeat", default=3, type=int)
+    p.set_defaults(func=bench_preprocess)
+
+    p = sub.add_parser("heads", help="Full forward vs inference_only forward, with a parity check.")
+    p.add_argument("--size", default=320, type=int)
+    p.add_argument("--batch", default=1, type=int)
+    p.add_argument("--repeat", default=3, type=int)
+    p.set_defaults(func=bench_heads)
+
+    p = sub.add_parser("quantize", help="int8 vs fp32 throughput and mask IoU.")
+    p.add_argument("--model", default="u2netp", choices=["u2net", "u2netp", "u2net_human_seg"])
+    p.add_argument("--count", default=16, type=int)
+    p.add_argument("--width", default=640, type=int)
+    p.add_argument("--height", default=480, type=int)
+    p.add_argument("--repeat", default=2, type=int)
+    p.set_defaults(func=bench_quantize)
+
+    p = sub.add_parser("fold", help="BN folding + channels_last vs eager, with a parity check.")
+    p.add_argument("--size", default=320, type=int)
+    p.add_argument("--batch", default=1, type=int)
+    p.add_argument("--repeat", default=3, type=int)
+    p.set_defaults(func=bench_fold)
+
+    p = sub.add_parser("decode", help="Full vs JPEG draft decode for the mask pass.")
+    p.add_argument("--megapixels", nargs="+", default=[12, 24, 48], type=float)
+    p.add_argument("--size", default=320, type=int)
+    p.add_argument("--repeat", default=3, type=int)
+    p.set_defaults(func=bench_decode)
+
+    p = sub.add_parser("frames", help="Video frame decoding, moviepy vs one ffmpeg rawvideo pipe.")
+    p.add_argument("--width", default=1920, type=int, help="width of the 16:9 test clip")
+    p.add_argument("--frames", default=100, type=int)
+    p.add_argument("--size", default=320, type=int, help="height frames are scaled to")
+    p.add_argument("--threads", nargs="+", default=[0, 1], type=int, help="ffmpeg thread counts, 0 for auto")
+    p.add_argument("--repeat", default=3, type=int)
+    p.set_defaults(func=bench_frames)
+
+    p = sub.add_parser("composite", help="Threshold/upscale/blend stage vs the PIL chain, with a parity check.")
+    p.add_argument("--width", default=3264, type=int)
+    p.add_argument("--height", default=2448, type=int)
+    p.add_argument("--repeat", default=3, type=int)
+    p.set_defaults(func=bench_composite)
+
+    p = sub.add_parser("upsample", help="Mask upsamplers: time and edge error against a known alpha.")
+    p.add_argument("--sizes", nargs="+", default=["1920x1080", "3264x2448", "6000x4000"])
+    p.add_argument("--size", default=320, type=int, help="model resolution of the mask")
+    p.add_argument("--blur", default=0.5, type=float, help="softness of the simulated prediction")
+    p.add_argument("--repeat", default=3, type=int)
+    p.set_defaults(func=bench_upsample)
+
+    p = sub.add_parser("matting", help="Matting engines: time, peak memory and alpha error against a known matte.")
+    p.add_argument("--sizes", nargs="+", default=[500, 1000, 2000], type=int, help="long side, as -az")
+    p.add_argument("--engines", nargs="+", default=["cf-full", "cf", "guided"])
+    p.add_argument("--workers", default=1, type=int, help="processes for cf")
+    p.add_argument("--erode", default=10, type=int, help="trimap erosion, as -ae")
+    p.add_argument("--blur", default=1.0, type=float, help="softness of the simulated prediction")
+    p.add_argument("--repeat", default=1, type=int)
+    p.set_defaults(func=bench_matting)
+
+    p = sub.add_parser("tiles", help="Full resolution tiled matting vs matting at the base size: "
+                                     "time, peak RSS and seam error.")
+    p.add_argument("--size", default=4000, type=int, help="long side of the image")
+    p.add_argument("--memory", default="4G", help="budget, as -amm")
+    p.add_argument("--engines", nargs="+", default=["cf", "guided"])
+    p.add_argument("--modes", nargs="+", default=["base", "full", "tiled"],
+                   help="leave out full where it does not fit in memory")
+    p.add_argument("--erode", default=10, type=int, help="trimap erosion at the base size, as -ae")
+    p.add_argument("--blur", default=1.0, type=float, help="softness of the simulated prediction")
+    p.add_argument("--workers", default=os.cpu_count() or 1, type=int, help="matting processes, as -amw")
+    p.add_argument("--case", default=None, choices=["base", "full", "tiled"], help=argparse.SUPPRESS)
+    p.add_argument("--case-dir", default=None, help=argparse.SUPPRESS)
+    p.add_argument("--engine", default="cf", help=argparse.SUPPRESS)
+    p.set_defaults(func=bench_tiles)
+
+    p = sub.add_parser("encode", help="Output encoders on an RGBA cutout.")
+    p.add_argument("--width", default=3840, type=int)
+    p.add_argument("--height", default=2160, type=int)
+    p.add_argument("--repeat", default=3, type=int)
+    p.set_defaults(func=bench_encode)
+
+    p = sub.add_parser("pipeline", help="Video pipeline hand-offs vs the same work in one process, fails "
+                                        "if the pipeline adds latency per batch.")
+    p.add_argument("--frames", nargs=2, default=[4, 200], type=int, help="a short and a longer clip")
+    p.add_argument("--workers", default=1, type=int, help="as -wn")
+    p.add_argument("--batch", default=2, type=int, help="as -gb")
+    p.add_argument("--size", default=64, type=int, help="frame height and model input size")
+    p.add_argument("--budget", default=0.01, type=float, help="maximum overhead per batch in seconds")
+    p.add_argument("--repeat", default=3, type=int)
+    p.set_defaults(func=bench_pipeline)
+
+    p = sub.add_parser("startup", help="Import time of the library and CLI, fails if over budget.")
+    p.add_argument("--modules", nargs="+", default=["backgroundremover.bg", "backgroundremover.cmd.cli"])
+    p.add_argument("--budget", default=None, type=float, help="maximum import time in seconds")
+    p.add_argument("--repeat", default=3, type=int)
+    p.set_defaults(func=bench_startup)
+
+    args = ap.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
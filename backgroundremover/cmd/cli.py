@@ -1,8 +1,34 @@
 import argparse
 import os
 from distutils.util import strtobool
-from .. import utilities
-from ..bg import remove, max_workers
+from .. import backends, utilities
+from ..bg import remove, max_workers, INFERENCE_SIZE_PRESETS, MIN_INFERENCE_SIZE, OUTPUT_FORMATS
+from ..matting import MATTING_ENGINES, parse_memory
+from ..upsample import MASK_UPSAMPLERS
+
+
+def inference_size(value):
+    if value in INFERENCE_SIZE_PRESETS:
+        return INFERENCE_SIZE_PRESETS[value]
+    try:
+        size = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            f"expected a size in pixels or one of {', '.join(INFERENCE_SIZE_PRESETS)}"
+        )
+    if size < MIN_INFERENCE_SIZE:
+        raise argparse.ArgumentTypeError(f"inference size must be at least {MIN_INFERENCE_SIZE} pixels")
+    return size
+
+
+def quality(value):
+    try:
+        level = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected a quality from 1 to 100")
+    if not 1 <= level <= 100:
+        raise argparse.ArgumentTypeError("quality must be from 1 to 100")
+    return level
 
 
 def main():
@@ -61,6 +87,35 @@ def main():
         help="The image base size.",
     )
 
+    ap.add_argument(
+        "-ame",
+        "--alpha-matting-engine",
+        default="cf",
+        choices=MATTING_ENGINES,
+        help="Matting algorithm for -a. cf is closed-form matting; guided is a guided filter that is "
+             "much faster and uses far less memory, with slightly less detail in hair.",
+    )
+
+    ap.add_argument(
+        "-amm",
+        "--alpha-matting-memory",
+        default=None,
+        type=parse_memory,
+        metavar="SIZE",
+        help="Matte at full resolution instead of the base size, in tiles along the edge that fit "
+             "in this much memory, e.g. 12G.",
+    )
+
+    ap.add_argument(
+        "-amw",
+        "--alpha-matting-workers",
+        default=None,
+        type=int,
+        metavar="N",
+        help="Processes alpha matting may use for large edges and tiles (default 1, or "
+             "BACKGROUNDREMOVER_MATTING_WORKERS).",
+    )
+
     ap.add_argument(
         "-om",
         "--only-mask",
@@ -79,6 +134,82 @@ def main():
         help="Threshold (0-255) to binarize the mask for hard/sharp edges. Useful for cartoonish images. Values around 128 work well.",
     )
 
+    ap.add_argument(
+        "-mu",
+        "--mask-upsample",
+        default="lanczos",
+        choices=MASK_UPSAMPLERS,
+        help="How the mask is scaled up to the image size. bilinear is about twice as fast as the default "
+             "lanczos on large photos and bicubic a little faster; guided is slower but snaps the mask edges to edges in the "
+             "image. Not used with -a.",
+    )
+
+    ap.add_argument(
+        "-is",
+        "--inference-size",
+        default=320,
+        type=inference_size,
+        help="Model input resolution in pixels, or a preset: fastest (192), fast (256), default (320), quality (448). "
+             "Smaller is faster with softer edges.",
+    )
+
+    ap.add_argument(
+        "-q",
+        "--quantize",
+        default=None,
+        choices=["int8"],
+        help="Run the model with int8 weights on the CPU. Faster on CPU-only machines with slightly "
+             "different masks; the quantized model is built once and cached next to the .pth file.",
+    )
+
+    ap.add_argument(
+        "--backend",
+        default="torch",
+        choices=["torch", "onnx"],
+        help="Inference backend. onnx runs the model with onnxruntime on the CPU and exports it to "
+             "ONNX next to the .pth file on first use (needs `pip install onnxruntime onnx`).",
+    )
+
+    ap.add_argument(
+        "--export-onnx",
+        nargs="?",
+        const="",
+        default=None,
+        metavar="PATH",
+        help="Export the selected model (-m) to ONNX and exit. Defaults to a .onnx file next to the .pth weights.",
+    )
+
+    ap.add_argument(
+        "-fmt",
+        "--format",
+        default=None,
+        choices=OUTPUT_FORMATS,
+        help="Image output format. webp keeps transparency at a fraction of the PNG encode time; "
+             "jpeg needs -bc/-bi since it has no alpha; raw writes the bare RGBA pixels. Defaults to png.",
+    )
+
+    ap.add_argument(
+        "--compress-level",
+        default=6,
+        type=int,
+        choices=range(10),
+        metavar="{0-9}",
+        help="PNG compression level, lower is faster but larger (default 6).",
+    )
+
+    ap.add_argument(
+        "--optimize",
+        action="store_true",
+        help="Make the smallest PNG the encoder can, at a much slower encode. Overrides --compress-level.",
+    )
+
+    ap.add_argument(
+        "--quality",
+        default=None,
+        type=quality,
+        help="Quality (1-100) for jpeg and lossy webp. webp is lossless unless this is set.",
+    )
+
     ap.add_argument(
         "-bc",
         "--background-color",
@@ -232,6 +363,21 @@ def main():
 
     args = ap.parse_args()
 
+    if args.export_onnx is not None:
+        backends.export_onnx(args.model, args.export_onnx or None)
+        return
+
+    if args.quantize and args.backend != "torch":
+        print("Error: -q/--quantize is only supported with the torch backend.")
+        exit(1)
+
+    output_options = dict(
+        output_format=args.format or "png",
+        compress_level=args.compress_level,
+        optimize=args.optimize,
+        quality=args.quality,
+    )
+
     # Validate that -toi and -tov have their required background arguments
     if args.transparentvideooverimage and (not args.backgroundimage or args.backgroundimage.name == "<stdin>"):
         print("Error: -toi/--transparentvideooverimage requires -bi/--backgroundimage to specify the background image.")
@@ -272,6 +418,10 @@ def main():
         r = lambda i: i.buffer.read() if hasattr(i, "buffer") else i.read()
         background_image = r(args.backgroundimage)
 
+    if args.format == "jpeg" and not (args.only_mask or background_color or background_image):
+        print("Error: -fmt jpeg has no transparency, use it with -bc/--background-color, -bi/--backgroundimage or -om.")
+        exit(1)
+
     def is_video_file(filename):
         return filename.lower().endswith((".mp4", ".mov", ".webm", ".ogg", ".gif"))
 
@@ -296,7 +446,10 @@ def main():
                                         gpu_batchsize=args.gpubatchsize,
                                         model_name=args.model,
                                         frame_limit=args.framelimit,
-                                        framerate=args.framerate)
+                                        framerate=args.framerate,
+                                        inference_size=args.inference_size,
+                                        quantize=args.quantize,
+                                        backend=args.backend)
                 elif args.transparentvideo:
                     utilities.transparentvideo(output_path, input_path,
                                                worker_nodes=args.workernodes,
@@ -305,7 +458,10 @@ def main():
                                                frame_limit=args.framelimit,
                                                framerate=args.framerate,
                                                alpha_codec=args.alpha_codec,
-                                               alpha_pix_fmt=args.alpha_pix_fmt)
+                                               alpha_pix_fmt=args.alpha_pix_fmt,
+                                               inference_size=args.inference_size,
+                                               quantize=args.quantize,
+                                               backend=args.backend)
                 elif args.transparentvideoovervideo:
                     utilities.transparentvideoovervideo(output_path, os.path.abspath(args.backgroundvideo.name),
                                                         input_path,
@@ -315,7 +471,10 @@ def main():
                                                         frame_limit=args.framelimit,
                                                         framerate=args.framerate,
                                                         alpha_codec=args.alpha_codec,
-                                                        alpha_pix_fmt=args.alpha_pix_fmt)
+                                                        alpha_pix_fmt=args.alpha_pix_fmt,
+                                                        inference_size=args.inference_size,
+                                                        quantize=args.quantize,
+                                                        backend=args.backend)
                 elif args.transparentvideooverimage:
                     utilities.transparentvideooverimage(output_path, os.path.abspath(args.backgroundimage.name),
                                                         input_path,
@@ -325,40 +484,56 @@ def main():
                                                         frame_limit=args.framelimit,
                                                         framerate=args.framerate,
                                                         alpha_codec=args.alpha_codec,
-                                                        alpha_pix_fmt=args.alpha_pix_fmt)
+                                                        alpha_pix_fmt=args.alpha_pix_fmt,
+                                                        inference_size=args.inference_size,
+                                                        quantize=args.quantize,
+                                                        backend=args.backend)
                 elif args.transparentgif:
                     utilities.transparentgif(output_path, input_path,
                                              worker_nodes=args.workernodes,
                                              gpu_batchsize=args.gpubatchsize,
                                              model_name=args.model,
                                              frame_limit=args.framelimit,
-                                             framerate=args.framerate)
+                                             framerate=args.framerate,
+                                             inference_size=args.inference_size,
+                                             quantize=args.quantize,
+                                             backend=args.backend)
                 elif args.transparentgifwithbackground:
                     utilities.transparentgifwithbackground(output_path, os.path.abspath(args.backgroundimage.name), input_path,
                                                            worker_nodes=args.workernodes,
                                                            gpu_batchsize=args.gpubatchsize,
                                                            model_name=args.model,
                                                            frame_limit=args.framelimit,
-                                                           framerate=args.framerate)
+                                                           framerate=args.framerate,
+                                                           inference_size=args.inference_size,
+                                                           quantize=args.quantize,
+                                                           backend=args.backend)
             elif is_image_file(f):
+                if args.format:
+                    output_path = os.path.splitext(output_path)[0] + "." + args.format
                 with open(input_path, "rb") as i, open(output_path, "wb") as o:
                     r = lambda i: i.buffer.read() if hasattr(i, "buffer") else i.read()
-                    w = lambda o, data: o.buffer.write(data) if hasattr(o, "buffer") else o.write(data)
-                    w(
-                        o,
-                        remove(
-                            r(i),
-                            model_name=args.model,
-                            alpha_matting=args.alpha_matting,
-                            alpha_matting_foreground_threshold=args.alpha_matting_foreground_threshold,
-                            alpha_matting_background_threshold=args.alpha_matting_background_threshold,
-                            alpha_matting_erode_structure_size=args.alpha_matting_erode_size,
-                            alpha_matting_base_size=args.alpha_matting_base_size,
-                            only_mask=args.only_mask,
-                            background_color=background_color,
-                            background_image=background_image,
-                            mask_threshold=args.mask_threshold,
-                        ),
+                    remove(
+                        r(i),
+                        model_name=args.model,
+                        alpha_matting=args.alpha_matting,
+                        alpha_matting_foreground_threshold=args.alpha_matting_foreground_threshold,
+                        alpha_matting_background_threshold=args.alpha_matting_background_threshold,
+                        alpha_matting_erode_structure_size=args.alpha_matting_erode_size,
+                        alpha_matting_base_size=args.alpha_matting_base_size,
+                        only_mask=args.only_mask,
+                        background_color=background_color,
+                        background_image=background_image,
+                        mask_threshold=args.mask_threshold,
+                        inference_size=args.inference_size,
+                        quantize=args.quantize,
+                        backend=args.backend,
+                        mask_upsample=args.mask_upsample,
+                        alpha_matting_engine=args.alpha_matting_engine,
+                        alpha_matting_memory=args.alpha_matting_memory,
+                        alpha_matting_workers=args.alpha_matting_workers,
+                        **output_options,
+                        output=o,
                     )
         return
 
@@ -367,21 +542,26 @@ def main():
     if args.input.name == "<stdin>" or args.output.name == "<stdout>":
         # Pipe mode - assume image processing
         r = lambda i: i.buffer.read() if hasattr(i, "buffer") else i.read()
-        w = lambda o, data: o.buffer.write(data) if hasattr(o, "buffer") else o.write(data)
-        w(
-            args.output,
-            remove(
-                r(args.input),
-                model_name=args.model,
-                alpha_matting=args.alpha_matting,
-                alpha_matting_foreground_threshold=args.alpha_matting_foreground_threshold,
-                alpha_matting_background_threshold=args.alpha_matting_background_threshold,
-                alpha_matting_erode_structure_size=args.alpha_matting_erode_size,
-                alpha_matting_base_size=args.alpha_matting_base_size,
-                only_mask=args.only_mask,
-                background_color=background_color,
-                background_image=background_image,
-            ),
+        remove(
+            r(args.input),
+            model_name=args.model,
+            alpha_matting=args.alpha_matting,
+            alpha_matting_foreground_threshold=args.alpha_matting_foreground_threshold,
+            alpha_matting_background_threshold=args.alpha_matting_background_threshold,
+            alpha_matting_erode_structure_size=args.alpha_matting_erode_size,
+            alpha_matting_base_size=args.alpha_matting_base_size,
+            only_mask=args.only_mask,
+            background_color=background_color,
+            background_image=background_image,
+            inference_size=args.inference_size,
+            quantize=args.quantize,
+            backend=args.backend,
+            mask_upsample=args.mask_upsample,
+            alpha_matting_engine=args.alpha_matting_engine,
+            alpha_matting_memory=args.alpha_matting_memory,
+            alpha_matting_workers=args.alpha_matting_workers,
+            **output_options,
+            output=args.output.buffer if hasattr(args.output, "buffer") else args.output,
         )
         return
 
@@ -394,7 +574,10 @@ def main():
                                 gpu_batchsize=args.gpubatchsize,
                                 model_name=args.model,
                                 frame_limit=args.framelimit,
-                                framerate=args.framerate)
+                                framerate=args.framerate,
+                                inference_size=args.inference_size,
+                                quantize=args.quantize,
+                                backend=args.backend)
         elif args.transparentvideo:
             utilities.transparentvideo(os.path.abspath(args.output.name), os.path.abspath(args.input.name),
                                        worker_nodes=args.workernodes,
@@ -403,7 +586,10 @@ def main():
                                        frame_limit=args.framelimit,
                                        framerate=args.framerate,
                                        alpha_codec=args.alpha_codec,
-                                       alpha_pix_fmt=args.alpha_pix_fmt)
+                                       alpha_pix_fmt=args.alpha_pix_fmt,
+                                       inference_size=args.inference_size,
+                                       quantize=args.quantize,
+                                       backend=args.backend)
         elif args.transparentvideoovervideo:
             utilities.transparentvideoovervideo(os.path.abspath(args.output.name), os.path.abspath(args.backgroundvideo.name),
                                                 os.path.abspath(args.input.name),
@@ -413,7 +599,10 @@ def main():
                                                 frame_limit=args.framelimit,
                                                 framerate=args.framerate,
                                                 alpha_codec=args.alpha_codec,
-                                                alpha_pix_fmt=args.alpha_pix_fmt)
+                                                alpha_pix_fmt=args.alpha_pix_fmt,
+                                                inference_size=args.inference_size,
+                                                quantize=args.quantize,
+                                                backend=args.backend)
         elif args.transparentvideooverimage:
             utilities.transparentvideooverimage(os.path.abspath(args.output.name), os.path.abspath(args.backgroundimage.name),
                                                 os.path.abspath(args.input.name),
@@ -423,39 +612,53 @@ def main():
                                                 frame_limit=args.framelimit,
                                                 framerate=args.framerate,
                                                 alpha_codec=args.alpha_codec,
-                                                alpha_pix_fmt=args.alpha_pix_fmt)
+                                                alpha_pix_fmt=args.alpha_pix_fmt,
+                                                inference_size=args.inference_size,
+                                                quantize=args.quantize,
+                                                backend=args.backend)
         elif args.transparentgif:
             utilities.transparentgif(os.path.abspath(args.output.name), os.path.abspath(args.input.name),
                                      worker_nodes=args.workernodes,
                                      gpu_batchsize=args.gpubatchsize,
                                      model_name=args.model,
                                      frame_limit=args.framelimit,
-                                     framerate=args.framerate)
+                                     framerate=args.framerate,
+                                     inference_size=args.inference_size,
+                                     quantize=args.quantize,
+                                     backend=args.backend)
         elif args.transparentgifwithbackground:
             utilities.transparentgifwithbackground(os.path.abspath(args.output.name), os.path.abspath(args.backgroundimage.name), os.path.abspath(args.input.name),
                                                    worker_nodes=args.workernodes,
                                                    gpu_batchsize=args.gpubatchsize,
                                                    model_name=args.model,
                                                    frame_limit=args.framelimit,
-                                                   framerate=args.framerate)
+                                                   framerate=args.framerate,
+                                                   inference_size=args.inference_size,
+                                                   quantize=args.quantize,
+                                                   backend=args.backend)
 
     elif ext in [".jpg", ".jpeg", ".png", ".heic", ".heif"]:
         r = lambda i: i.buffer.read() if hasattr(i, "buffer") else i.read()
-        w = lambda o, data: o.buffer.write(data) if hasattr(o, "buffer") else o.write(data)
-        w(
-            args.output,
-            remove(
-                r(args.input),
-                model_name=args.model,
-                alpha_matting=args.alpha_matting,
-                alpha_matting_foreground_threshold=args.alpha_matting_foreground_threshold,
-                alpha_matting_background_threshold=args.alpha_matting_background_threshold,
-                alpha_matting_erode_structure_size=args.alpha_matting_erode_size,
-                alpha_matting_base_size=args.alpha_matting_base_size,
-                only_mask=args.only_mask,
-                background_color=background_color,
-                background_image=background_image,
-            ),
+        remove(
+            r(args.input),
+            model_name=args.model,
+            alpha_matting=args.alpha_matting,
+            alpha_matting_foreground_threshold=args.alpha_matting_foreground_threshold,
+            alpha_matting_background_threshold=args.alpha_matting_background_threshold,
+            alpha_matting_erode_structure_size=args.alpha_matting_erode_size,
+            alpha_matting_base_size=args.alpha_matting_base_size,
+            only_mask=args.only_mask,
+            background_color=background_color,
+            background_image=background_image,
+            inference_size=args.inference_size,
+            quantize=args.quantize,
+            backend=args.backend,
+            mask_upsample=args.mask_upsample,
+            alpha_matting_engine=args.alpha_matting_engine,
+            alpha_matting_memory=args.alpha_matting_memory,
+            alpha_matting_workers=args.alpha_matting_workers,
+            **output_options,
+            output=args.output.buffer if hasattr(args.output, "buffer") else args.output,
         )
     else:
         print(f"❌ Unsupported file type: {ext}")
@@ -8,10 +8,18 @@ from urllib.request import urlopen
 from flask import Flask, request, send_file
 from waitress import serve
 
-from ..bg import remove
+from ..bg import remove, preload_models, MIN_INFERENCE_SIZE
+from ..matting import MATTING_ENGINES, parse_memory
+from ..upsample import MASK_UPSAMPLERS
 
 app = Flask(__name__)
 
+# formats the server can negotiate through the Accept header, png first as the default
+MIMETYPES = {"image/png": "png", "image/webp": "webp"}
+# the model's activations grow with the square of the input size, so one
+# request cannot ask for an arbitrarily large forward pass
+MAX_INFERENCE_SIZE = 1024
+
 
 @app.route("/", methods=["GET", "POST"])
 def index():
@@ -38,36 +46,71 @@ def index():
     ab = request.values.get("ab", type=int, default=10)
     ae = request.values.get("ae", type=int, default=10)
     az = request.values.get("az", type=int, default=1000)
+    ame = request.values.get("ame", type=str, default="cf")
+    if ame not in MATTING_ENGINES:
+        return {"error": f"invalid query param 'ame'. Available options are {list(MATTING_ENGINES)}"}, 400
+    amm = request.values.get("amm", type=str, default=None)
+    if amm is not None:
+        try:
+            amm = parse_memory(amm)
+        except ValueError:
+            return {"error": "invalid query param 'amm'. Expected a size like '12G'"}, 400
     mt = request.values.get("mt", type=int, default=None)
+    inference_size = request.values.get("is", type=int, default=320)
+    if not MIN_INFERENCE_SIZE <= inference_size <= MAX_INFERENCE_SIZE:
+        return {"error": f"invalid query param 'is'. Expected {MIN_INFERENCE_SIZE} to {MAX_INFERENCE_SIZE} pixels"}, 400
+    quantize = request.values.get("quantize", type=str, default=None)
+    if quantize not in (None, "int8"):
+        return {"error": "invalid query param 'quantize'. Available options are ['int8']"}, 400
+    backend = request.values.get("backend", type=str, default="torch")
+    if backend not in ("torch", "onnx"):
+        return {"error": "invalid query param 'backend'. Available options are ['torch', 'onnx']"}, 400
+    if quantize == "int8" and backend == "onnx":
+        return {"error": "query param 'quantize=int8' needs 'backend=torch'"}, 400
+    mask_upsample = request.values.get("mu", type=str, default="lanczos")
+    if mask_upsample not in MASK_UPSAMPLERS:
+        return {"error": f"invalid query param 'mu'. Available options are {list(MASK_UPSAMPLERS)}"}, 400
 
     model = request.args.get("model", type=str, default="u2net")
     model_path = os.environ.get(
         "U2NETP_PATH",
         os.path.expanduser(os.path.join("~", ".u2net")),
     )
-    model_choices = [os.path.splitext(os.path.basename(x))[0] for x in set(glob.glob(model_path + "/*"))]
+    # only the weights; the folder also holds caches derived from them (.int8.pt, .onnx, compiled/)
+    model_choices = [os.path.splitext(os.path.basename(x))[0] for x in set(glob.glob(model_path + "/*.pth"))]
     if len(model_choices) == 0:
         model_choices = ["u2net", "u2netp", "u2net_human_seg"]
 
     if model not in model_choices:
         return {"error": f"invalid query param 'model'. Available options are {model_choices}"}, 400
 
+    mimetype = request.accept_mimetypes.best_match(list(MIMETYPES), default="image/png")
+
     try:
-        return send_file(
-            BytesIO(
-                remove(
-                    file_content,
-                    model_name=model,
-                    alpha_matting=alpha_matting,
-                    alpha_matting_foreground_threshold=af,
-                    alpha_matting_background_threshold=ab,
-                    alpha_matting_erode_structure_size=ae,
-                    alpha_matting_base_size=az,
-                    mask_threshold=mt,
-                )
-            ),
-            mimetype="image/png",
+        output = BytesIO()
+        remove(
+            file_content,
+            model_name=model,
+            alpha_matting=alpha_matting,
+            alpha_matting_foreground_threshold=af,
+            alpha_matting_background_threshold=ab,
+            alpha_matting_erode_structure_size=ae,
+            alpha_matting_base_size=az,
+            alpha_matting_engine=ame,
+            alpha_matting_memory=amm,
+            mask_threshold=mt,
+            inference_size=inference_size,
+            quantize=quantize,
+            backend=backend,
+            mask_upsample=mask_upsample,
+            output_format=MIMETYPES[mimetype],
+            output=output,
         )
+        output.seek(0)
+        response = send_file(output, mimetype=mimetype)
+        # the format depends on the Accept header, so caches must key on it
+        response.headers["Vary"] = "Accept"
+        return response
     except Exception as e:
         app.logger.exception(e, exc_info=True)
         return {"error": "oops, something went wrong!"}, 500
@@ -92,7 +135,17 @@ def main():
         help="The port to bind to.",
     )
 
+    ap.add_argument(
+        "--preload",
+        nargs="*",
+        default=[],
+        choices=["u2net", "u2netp", "u2net_human_seg"],
+        help="Models to load into memory before accepting requests.",
+    )
+
     args = ap.parse_args()
+    if args.preload:
+        preload_models(args.preload)
     serve(app, host=args.addr, port=args.port)
 
 
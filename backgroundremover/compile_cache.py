@@ -0,0 +1,94 @@
+import hashlib
+import os
+
+import torch
+
+from .bg import Net, inference_device
+from .u2net import detect, optimize
+
+# bump when the traced graph changes in a way old artifacts cannot express
+CACHE_VERSION = 3
+
+
+def cache_dir(model_name):
+    """Directory holding traced models, ``compiled/`` next to the weights by default."""
+    return os.environ.get(
+        "BACKGROUNDREMOVER_COMPILE_CACHE",
+        os.path.join(os.path.dirname(os.path.abspath(detect.model_path(model_name))), "compiled"),
+    )
+
+
+def weights_fingerprint(model_name):
+    """Cheap identity of the weights file: name, size and modification time."""
+    stat = os.stat(detect.model_path(model_name))
+    return f"{model_name}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def cache_path(model_name, input_shape, inference_size=320, quantize=None):
+    device = inference_device(quantize)
+    key = repr((
+        CACHE_VERSION,
+        weights_fingerprint(model_name),
+        tuple(input_shape),
+        inference_size,
+        quantize or "float32",
+        device.type,
+        torch.__version__,
+    ))
+    digest = hashlib.sha1(key.encode()).hexdigest()[:16]
+    return os.path.join(cache_dir(model_name), f"{model_name}-{digest}.pt")
+
+
+def _save(traced, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # concurrent workers never load a partial file, and other users can read it
+    detect.save_atomic(path, lambda tmp: torch.jit.save(traced, tmp))
+
+
+def load_traced(model_name, example, inference_size=320, quantize=None):
+    """Return a TorchScript ``bg.Net`` for inputs shaped like ``example``.
+
+    Traced modules are cached on disk keyed by the weights, input shape,
+    dtype, device type and torch version, so only the first run for a given
+    combination pays for tracing. ``example`` is a float32 NHWC batch on the
+    inference device.
+
+    Float models are cached as bare graphs: the weights are stripped before
+    saving and the loaded graph is bound to the engine in the model
+    registry. Video workers register an engine built on the parent's shared
+    weights, so they never hold a copy of their own. int8 models keep their
+    packed weights inside the file.
+    """
+    device = inference_device(quantize)
+    path = None
+    try:
+        path = cache_path(model_name, example.shape, inference_size, quantize)
+    except OSError:
+        pass  # weights not downloaded yet, Net() below fetches them
+
+    net = Net(model_name, inference_size, quantize)
+    state = None if quantize else net.state_dict()
+
+    if path and os.path.exists(path):
+        try:
+            traced = torch.jit.load(path, map_location=device).eval()
+            if state is not None:
+                optimize.bind_weights(traced, state)
+            return traced
+        except Exception as e:
+            print(f"Ignoring unreadable compiled model {path}: {e}")
+
+    with torch.no_grad():
+        traced = torch.jit.trace(net, example)
+
+    path = path or cache_path(model_name, example.shape, inference_size, quantize)
+    try:
+        if state is not None:
+            optimize.bind_weights(traced, {name: t.new_empty(0) for name, t in state.items()})
+        _save(traced, path)
+    except OSError as e:
+        print(f"Could not cache compiled model at {path}: {e}")
+    finally:
+        if state is not None:
+            optimize.bind_weights(traced, state)
+    return traced
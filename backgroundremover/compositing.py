@@ -0,0 +1,89 @@
+import numpy as np
+from PIL import Image, ImageColor
+
+# rows blended per block; small enough that the uint16 scratch stays in cache
+BLOCK_ROWS = 32
+
+
+def threshold_lut(mask_threshold=None):
+    """256-entry lookup table for the mask threshold (identity when None)."""
+    lut = np.arange(256, dtype=np.uint8)
+    if mask_threshold is not None:
+        lut = np.where(lut > mask_threshold, 255, 0).astype(np.uint8)
+    return lut
+
+
+def upscale_mask(mask, size, mask_threshold=None):
+    """Threshold the model-resolution ``mask`` and scale it to ``size`` once.
+
+    ``mask`` is an L image, ``size`` a (width, height) pair. Returns a uint8
+    array; the threshold is applied before scaling, as ``remove()`` always did.
+    """
+    if mask_threshold is not None:
+        mask = mask.point(threshold_lut(mask_threshold).tolist())
+    return np.asarray(mask.resize(size, Image.LANCZOS))
+
+
+def background_rgb(background_color):
+    """RGB tuple for a colour given as a tuple or any name Pillow understands."""
+    if isinstance(background_color, str):
+        return ImageColor.getrgb(background_color)[:3]
+    return tuple(background_color)[:3]
+
+
+def _div255(value, scratch):
+    # exact round(value / 255) for value <= 255 * 255, the way Pillow blends
+    value += 128
+    np.right_shift(value, 8, out=scratch)
+    value += scratch
+    value >>= 8
+    return value
+
+
+def composite(image, alpha, background=None, premultiply=True, rows=BLOCK_ROWS):
+    """Blend ``image`` under ``alpha`` onto transparent, a colour or an image.
+
+    ``image`` is an HxWx3 uint8 array and ``alpha`` an HxW uint8 array of the
+    same size. With ``premultiply`` the colour is first scaled by ``alpha``,
+    which is what ``naive_cutout`` produces; matting results are passed with
+    ``premultiply=False``. ``background`` is None for an HxWx4 RGBA result,
+    or an RGB tuple or HxWx3 uint8 array for an HxWx3 RGB result.
+
+    Works through ``rows`` rows at a time with scratch buffers reused across
+    blocks and writes straight into the result, so that is the only
+    full-size allocation. Pixels match Pillow's ``Image.composite``.
+    """
+    height, width = alpha.shape
+    if background is None:
+        out = np.empty((height, width, 4), dtype=np.uint8)
+        out[..., 3] = alpha
+        if not premultiply:
+            out[..., :3] = image
+            return out
+    else:
+        out = np.empty((height, width, 3), dtype=np.uint8)
+        if not isinstance(background, np.ndarray):
+            background = np.asarray(background_rgb(background), dtype=np.uint8).reshape(1, 1, 3)
+
+    rows = min(rows, height)
+    a = np.empty((rows, width, 1), dtype=np.uint16)
+    rgb = np.empty((rows, width, 3), dtype=np.uint16)
+    scratch = np.empty_like(rgb)
+    for top in range(0, height, rows):
+        block = slice(top, top + rows)
+        count = len(alpha[block])
+        a_block, rgb_block, scratch_block = a[:count], rgb[:count], scratch[:count]
+        np.copyto(a_block, alpha[block, :, np.newaxis])
+        np.copyto(rgb_block, image[block])
+        if premultiply:
+            rgb_block *= a_block
+            _div255(rgb_block, scratch_block)
+        if background is not None:
+            bg = background if background.shape[0] == 1 else background[block]
+            rgb_block *= a_block
+            np.subtract(255, a_block, out=a_block)
+            np.multiply(bg, a_block, out=scratch_block)
+            rgb_block += scratch_block
+            _div255(rgb_block, scratch_block)
+        out[block, :, :3] = rgb_block
+    return out
@@ -0,0 +1,44 @@
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+class FrameRing:
+    """Fixed number of video frames and their masks in one shared memory block.
+
+    Frame ``i`` goes in slot ``i % slots``. The reader fills a slot, a worker
+    reads the frame and writes its mask into the same slot, and the writer
+    takes the mask and frees the slot; the pipeline's queues tell each of
+    them when a slot is theirs. Frames and masks therefore move between
+    processes without being pickled or copied. Pickling the ring (to hand
+    it to a process) only sends the name of the block.
+    """
+
+    def __init__(self, slots, shape, name=None):
+        self.slots = slots
+        self.shape = tuple(shape[:2])
+        height, width = self.shape
+        size = slots * height * width * 4
+        self.owner = name is None
+        self.shm = shared_memory.SharedMemory(name=name, create=self.owner, size=size if self.owner else 0)
+
+        buf = self.shm.buf
+        self.frames = np.ndarray((slots, height, width, 3), dtype=np.uint8, buffer=buf)
+        self.masks = np.ndarray((slots, height, width), dtype=np.uint8, buffer=buf,
+                                offset=slots * height * width * 3)
+
+    def __reduce__(self):
+        return FrameRing, (self.slots, self.shape, self.shm.name)
+
+    def slot(self, index):
+        return index % self.slots
+
+    def put_masks(self, indices, masks):
+        self.masks[[index % self.slots for index in indices]] = masks
+
+    def close(self):
+        # views into the block have to go before it can be closed
+        del self.frames, self.masks
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
@@ -0,0 +1,115 @@
+import os
+import subprocess as sp
+import tempfile
+from fractions import Fraction
+
+import numpy as np
+
+
+def decode_threads():
+    # 0 lets ffmpeg pick, which is usually one thread per core
+    return int(os.environ.get("BACKGROUNDREMOVER_DECODE_THREADS", 0))
+
+
+def _rotation(stream):
+    rotation = stream.get("tags", {}).get("rotate")
+    for side_data in stream.get("side_data_list", []):
+        rotation = side_data.get("rotation", rotation)
+    return abs(int(float(rotation or 0))) % 180
+
+
+class FrameSource:
+    """Frames of a video decoded by one ffmpeg process and scaled to ``height`` rows.
+
+    ffmpeg scales the frames and converts them to RGB itself and writes them
+    raw to a pipe; :meth:`read` copies each one straight from the pipe into a
+    buffer the caller owns, such as a slot of a
+    :class:`~backgroundremover.framering.FrameRing`. Frames are as wide as
+    they were when moviepy resized the clip to ``height``.
+    """
+
+    def __init__(self, path, height=320, threads=None, info=None):
+        if info is None:
+            import ffmpeg
+            info = ffmpeg.probe(path)
+        self.info = info
+        self.stream = next((s for s in info["streams"] if s["codec_type"] == "video"), None)
+        if not self.stream:
+            raise Exception("Could not find video stream")
+
+        width, full_height = int(self.stream["width"]), int(self.stream["height"])
+        # ffmpeg applies the rotation in the metadata before scaling
+        if _rotation(self.stream) == 90:
+            width, full_height = full_height, width
+        self.shape = (height, int(width * height / full_height), 3)
+        self.path = path
+        self.threads = decode_threads() if threads is None else threads
+        self.proc = None
+        self.frames_read = 0
+
+    def expected_frames(self):
+        """Frame count from the container metadata, None if it does not say.
+
+        Some containers only store a duration, which gives an estimate.
+        """
+        if str(self.stream.get("nb_frames", "")).isdigit():
+            return int(self.stream["nb_frames"])
+        duration = self.stream.get("duration") or self.info.get("format", {}).get("duration")
+        rate = self.stream.get("avg_frame_rate", "0/0")
+        if duration and rate != "0/0":
+            return round(float(duration) * float(Fraction(rate)))
+        return None
+
+    def _start(self):
+        height, width, _ = self.shape
+        self.errors = tempfile.TemporaryFile()
+        command = ["ffmpeg", "-v", "error", "-nostdin", "-threads", str(self.threads), "-i", self.path,
+                   "-map", "0:v:0", "-vf", F"scale={width}:{height}:flags=lanczos",
+                   "-f", "rawvideo", "-pix_fmt", "rgb24", "-"]
+        # unbuffered, so frames go from the pipe into the caller's buffer without another copy
+        self.proc = sp.Popen(command, stdout=sp.PIPE, stderr=self.errors, bufsize=0)
+
+    def read(self, out=None):
+        """Read the next frame into ``out`` (a new array if not given), None at the end of the video."""
+        if self.proc is None:
+            self._start()
+        if out is None:
+            out = np.empty(self.shape, dtype=np.uint8)
+        view = memoryview(out).cast("B")
+        filled = 0
+        while filled < len(view):
+            count = self.proc.stdout.readinto(view[filled:])
+            if not count:
+                self._finish()
+                return None
+            filled += count
+        self.frames_read += 1
+        return out
+
+    def _finish(self):
+        # a failure partway through must not pass for the end of the video
+        returncode = self.proc.wait()
+        if returncode:
+            self.errors.seek(0)
+            message = self.errors.read().decode(errors="replace").strip()
+            self.close()
+            raise Exception(F"Could not decode {self.path} after {self.frames_read} frames "
+                            F"(ffmpeg exit code {returncode}): {message}")
+
+    def __iter__(self):
+        try:
+            frame = self.read()
+            while frame is not None:
+                yield frame
+                frame = self.read()
+        finally:
+            self.close()
+
+    def close(self):
+        if self.proc is not None:
+            if self.proc.poll() is None:
+                self.proc.kill()
+            self.proc.stdout.close()
+            self.proc.wait()
+            self.errors.close()
+            self.proc = None
@@ -1,41 +1,134 @@
+import json
 import os
 import requests
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 
+BASE_URL = 'https://github.com/nadermx/backgroundremover/raw/main/models'
 
-def download_files_from_github(path, model_name, max_retries=3):
+MODEL_PARTS = {
+    "u2net": ["u2aa", "u2ab", "u2ac", "u2ad"],
+    "u2net_human_seg": ["u2haa", "u2hab", "u2hac", "u2had"],
+    "u2netp": ["u2netp.pth"],
+}
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def model_sources(model_name):
+    """Where the parts of ``model_name`` are fetched from, in order.
+
+    BACKGROUNDREMOVER_MODEL_MIRROR may point at another base URL or at a
+    local directory holding the same part files.
+    """
+    base = os.environ.get("BACKGROUNDREMOVER_MODEL_MIRROR") or BASE_URL
+    if os.path.isdir(base):
+        return [os.path.join(base, part) for part in MODEL_PARTS[model_name]]
+    return [f"{base.rstrip('/')}/{part}" for part in MODEL_PARTS[model_name]]
+
+
+def part_size(source, timeout=60):
+    """Size in bytes of one part, None when the server does not say."""
+    if "://" not in source:  # part from a local mirror directory
+        return os.path.getsize(source)
+    response = requests.head(source, allow_redirects=True, timeout=timeout)
+    response.raise_for_status()
+    length = response.headers.get("Content-Length", "")
+    return int(length) if length.isdigit() else None
+
+
+def _write_chunks(chunks, out_file, offset, done, size, progress):
+    out_file.seek(offset + done)
+    for chunk in chunks:
+        if size is not None and done + len(chunk) > size:
+            raise ValueError(f"part is larger than the expected {size} bytes")
+        out_file.write(chunk)
+        done += len(chunk)
+        if progress:
+            # only count bytes that have reached the file
+            out_file.flush()
+            progress(done)
+    return done
+
+
+def download_part(source, out_file, offset, done=0, size=None, progress=None, timeout=60):
+    """Write one part into the open ``out_file`` at ``offset``.
+
+    The first ``done`` bytes of the part are already there, so only the rest
+    is fetched, with a Range request. ``progress`` is called with the bytes
+    of the part written so far after every chunk. Returns the size of the part.
+    """
+    if "://" not in source:  # part from a local mirror directory
+        with open(source, "rb") as part_file:
+            part_file.seek(done)
+            chunks = iter(lambda: part_file.read(CHUNK_SIZE), b"")
+            return _write_chunks(chunks, out_file, offset, done, size, progress)
+
+    headers = {"Range": f"bytes={done}-"} if done else {}
+    with requests.get(source, headers=headers, stream=True, timeout=timeout) as response:
+        if response.status_code == 416:  # nothing left to fetch
+            return done
+        response.raise_for_status()
+        if response.status_code != 206:
+            done = 0  # the server ignored Range and sends the whole part again
+        return _write_chunks(response.iter_content(CHUNK_SIZE), out_file, offset, done, size, progress)
+
+
+def _preallocate(out_file, size):
+    # reserve the space up front, which also fails early on a full disk
+    if hasattr(os, "posix_fallocate"):
+        os.posix_fallocate(out_file.fileno(), 0, size)
+    else:
+        out_file.truncate(size)
+
+
+def _load_progress(progress_path, tmp_path, sources):
+    """Progress of an earlier download of the same parts, None if there is none to resume."""
+    if not os.path.exists(tmp_path):
+        return None
+    try:
+        with open(progress_path) as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return state if state.get("sources") == sources else None
+
+
+def download_files_from_github(path, model_name, max_retries=3, md5=None):
     """Download model files from GitHub with validation and retry logic.
 
+    The sizes of the parts are looked up first, ``<path>.tmp`` is
+    preallocated to their total and the parts are downloaded concurrently,
+    each written straight to its offset. How far each part got is kept in
+    ``<path>.progress``, so a network error resumes every part where it
+    stopped. Servers that do not report sizes get the parts one after
+    another. When ``md5`` is given the complete file must match it, unless
+    BACKGROUNDREMOVER_SKIP_MD5 is set.
+
     Args:
         path: Destination path for the model file
         model_name: Name of the model to download
         max_retries: Maximum number of download attempts
+        md5: Expected MD5 hex digest of the complete file
 
     Returns:
         bool: True if download succeeded, False otherwise
     """
-    if model_name not in ["u2net", "u2net_human_seg", "u2netp"]:
+    if model_name not in MODEL_PARTS:
         print("Invalid model name, please use 'u2net' or 'u2net_human_seg' or 'u2netp'")
         return False
 
     print(f"downloading model [{model_name}] to {path} ...")
 
-    urls = []
-    if model_name == "u2net":
-        urls = ['https://github.com/nadermx/backgroundremover/raw/main/models/u2aa',
-                'https://github.com/nadermx/backgroundremover/raw/main/models/u2ab',
-                'https://github.com/nadermx/backgroundremover/raw/main/models/u2ac',
-                'https://github.com/nadermx/backgroundremover/raw/main/models/u2ad']
-    elif model_name == "u2net_human_seg":
-        urls = ['https://github.com/nadermx/backgroundremover/raw/main/models/u2haa',
-                'https://github.com/nadermx/backgroundremover/raw/main/models/u2hab',
-                'https://github.com/nadermx/backgroundremover/raw/main/models/u2hac',
-                'https://github.com/nadermx/backgroundremover/raw/main/models/u2had']
-    elif model_name == 'u2netp':
-        urls = ['https://github.com/nadermx/backgroundremover/raw/main/models/u2netp.pth']
+    sources = model_sources(model_name)
+    tmp_path = path + ".tmp"
+    progress_path = path + ".progress"
+    if os.environ.get("BACKGROUNDREMOVER_SKIP_MD5", "").lower() in ("1", "true", "yes"):
+        md5 = None
 
     try:
-        os.makedirs(os.path.expanduser("~/.u2net"), exist_ok=True)
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
     except Exception as e:
         print(f"Error creating directory: {e}")
         return False
@@ -47,24 +140,59 @@ def download_files_from_github(path, model_name, max_retries=3):
         "u2netp": 4500000,       # ~4.5 MB
     }
 
+    def remove_download():
+        for leftover in (tmp_path, progress_path):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+
+    lock = threading.Lock()
+    state = {}
+
+    def save_progress():
+        with open(progress_path, "w") as f:
+            json.dump(state, f)
+
+    def record(i, done):
+        with lock:
+            state["done"][i] = done
+            save_progress()
+
+    def fetch(i):
+        sizes, done = state["sizes"], state["done"]
+        # every earlier size is known here: either all were looked up, or the parts run in order
+        offset = sum(sizes[:i])
+        if sizes[i] is None or done[i] < sizes[i]:
+            with open(tmp_path, "r+b") as out_file:
+                count = download_part(sources[i], out_file, offset, done[i], sizes[i],
+                                      lambda n: record(i, n))
+            if sizes[i] is None:
+                with lock:
+                    sizes[i] = count
+                    save_progress()
+            elif count != sizes[i]:
+                raise ValueError(f"Part {i+1} of {model_name} is {count} bytes, expected {sizes[i]}")
+        print(f'finished downloading part {i+1}/{len(sources)} of {model_name}')
+
     for attempt in range(max_retries):
         try:
-            # Remove any existing partial/corrupt file
-            if os.path.exists(path):
-                os.remove(path)
-
-            with open(path, 'wb') as out_file:
-                for i, url in enumerate(urls):
-                    print(f'downloading part {i+1}/{len(urls)} of {model_name} (attempt {attempt+1}/{max_retries})')
-
-                    response = requests.get(url, timeout=60)
-                    response.raise_for_status()  # Raise error for bad status codes
+            print(f'downloading {len(sources)} part(s) of {model_name} (attempt {attempt+1}/{max_retries})')
+            previous = _load_progress(progress_path, tmp_path, sources)
+            if previous is None:
+                sizes = [part_size(source) for source in sources]
+                state.update(sources=sources, sizes=sizes, done=[0] * len(sources))
+                with open(tmp_path, "wb") as out_file:
+                    if None not in sizes:
+                        _preallocate(out_file, sum(sizes))
+                save_progress()
+            else:
+                state.update(previous)
 
-                    out_file.write(response.content)
-                    print(f'finished downloading part {i+1}/{len(urls)} of {model_name}')
+            workers = len(sources) if None not in state["sizes"] else 1
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                list(pool.map(fetch, range(len(sources))))
 
             # Validate downloaded file size
-            file_size = os.path.getsize(path)
+            file_size = os.path.getsize(tmp_path)
             expected_size = expected_sizes.get(model_name, 0)
 
             # Allow 10% variance in file size
@@ -76,10 +204,20 @@ def download_files_from_github(path, model_name, max_retries=3):
             if file_size < 1000:  # Less than 1KB is definitely wrong
                 raise ValueError(f"Downloaded file is too small ({file_size} bytes). Download failed.")
 
+            if md5:
+                from hsh.library.hash import Hasher
+
+                digest = Hasher().md5(tmp_path)
+                if digest != md5:
+                    raise ValueError(f"Checksum mismatch for {model_name} (got {digest}, expected {md5})")
+
+            os.replace(tmp_path, path)
+            remove_download()
             print(f"Successfully downloaded {model_name} ({file_size} bytes)")
             return True
 
         except requests.exceptions.RequestException as e:
+            # keep the file and its progress, the next attempt resumes them
             print(f"Network error downloading {model_name}: {e}")
             if attempt < max_retries - 1:
                 wait_time = 2 ** attempt  # Exponential backoff
@@ -87,16 +225,12 @@ def download_files_from_github(path, model_name, max_retries=3):
                 time.sleep(wait_time)
             else:
                 print(f"Failed to download {model_name} after {max_retries} attempts.")
-                # Clean up corrupt file
-                if os.path.exists(path):
-                    os.remove(path)
                 return False
 
         except Exception as e:
             print(f"Error downloading {model_name}: {e}")
-            # Clean up corrupt file
-            if os.path.exists(path):
-                os.remove(path)
+            # Clean up the corrupt download so the next attempt starts fresh
+            remove_download()
             if attempt < max_retries - 1:
                 wait_time = 2 ** attempt
                 print(f"Retrying in {wait_time} seconds...")
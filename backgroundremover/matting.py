@@ -0,0 +1,397 @@
+import collections
+import itertools
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+
+from .upsample import box_filter
+
+# ``cf`` is pymatting's closed-form matting, ``guided`` a guided filter that
+# is several times faster and far lighter on memory, with softer detail in hair
+MATTING_ENGINES = ("cf", "guided")
+
+# regularization of guided matting, relative to colours in [0, 1]
+GUIDED_EPS = 1e-5
+
+# known pixels kept around each unknown region for closed-form matting; its
+# 3x3 windows only couple pixels up to two apart, the rest is context for
+# the foreground estimate
+CROP_MARGIN = 8
+
+# below this many pixels in all crops together a process pool costs more than it saves
+POOL_MIN_PIXELS = 500_000
+
+# tiled matting: neighbouring windows overlap by this much and are blended
+# linearly across it; tile sides are kept between the two bounds
+TILE_OVERLAP = 64
+MIN_TILE = 128
+MAX_TILE = 1024
+
+# solver working set per window pixel, measured with pymatting 1.1 on windows
+# up to two thirds unknown; the guided engine works in float32
+BYTES_PER_PIXEL = {"cf": 2048, "guided": 160}
+
+# what tiled matting itself holds per image pixel: the float32 image, mask,
+# trimap, the weighted sums and the result
+TILED_BYTES_PER_PIXEL = 48
+
+# a pool process imports the calling script again, with torch that is about
+# 650 MB before it solves anything; the budget is only split over processes
+# once tiles reach POOL_TILE
+WORKER_BYTES = 640 * 2 ** 20
+POOL_TILE = 512
+
+
+def trimap(mask, foreground_threshold, background_threshold, erode_structure_size):
+    """Trimap of a uint8 ``mask``: 255 foreground, 0 background, 128 unknown."""
+    from scipy.ndimage import binary_erosion, minimum_filter
+
+    # guess likely foreground/background
+    is_foreground = mask > foreground_threshold
+    is_background = mask < background_threshold
+
+    # erode foreground/background
+    if erode_structure_size > 0:
+        # a square erosion is a separable minimum filter, the same result as
+        # binary_erosion and much faster on full resolution masks
+        size = erode_structure_size
+        is_foreground = minimum_filter(is_foreground, size=size, mode="constant", cval=0)
+        is_background = minimum_filter(is_background, size=size, mode="constant", cval=1)
+    else:
+        is_foreground = binary_erosion(is_foreground)
+        is_background = binary_erosion(is_background, border_value=1)
+
+    result = np.full(mask.shape, dtype=np.uint8, fill_value=128)
+    result[is_foreground] = 255
+    result[is_background] = 0
+    return result
+
+
+def _crop(region, margin):
+    """Slices of the bounding box of the boolean ``region`` grown by ``margin``, or None."""
+    rows = np.flatnonzero(region.any(axis=1))
+    if len(rows) == 0:
+        return None
+    cols = np.flatnonzero(region.any(axis=0))
+    return (slice(max(rows[0] - margin, 0), rows[-1] + margin + 1),
+            slice(max(cols[0] - margin, 0), cols[-1] + margin + 1))
+
+
+def guided_filter(image, p, radius, eps):
+    """Colour guided filter of ``p`` (HxW) steered by ``image`` (HxWx3), both float32.
+
+    Fits ``p ~ a . image + b`` in every (2r+1)x(2r+1) window and returns the
+    averaged fit, which follows the edges of ``image`` while smoothing ``p``.
+    Every step is a box filter or per-pixel arithmetic, so the cost is
+    linear in the number of pixels and independent of ``radius``.
+    """
+    mean_i = box_filter(image, radius)
+    mean_p = box_filter(p, radius)
+    cov_ip = box_filter(image * p[..., np.newaxis], radius) - mean_i * mean_p[..., np.newaxis]
+
+    # the symmetric 3x3 colour covariance in every window, regularized by eps
+    r, g, b = image[..., 0], image[..., 1], image[..., 2]
+    mr, mg, mb = mean_i[..., 0], mean_i[..., 1], mean_i[..., 2]
+    rr = box_filter(r * r, radius) - mr * mr + eps
+    rg = box_filter(r * g, radius) - mr * mg
+    rb = box_filter(r * b, radius) - mr * mb
+    gg = box_filter(g * g, radius) - mg * mg + eps
+    gb = box_filter(g * b, radius) - mg * mb
+    bb = box_filter(b * b, radius) - mb * mb + eps
+
+    # solve sigma . a = cov_ip with the adjugate, vectorized over all pixels
+    inv_rr = gg * bb - gb * gb
+    inv_rg = gb * rb - rg * bb
+    inv_rb = rg * gb - gg * rb
+    inv_gg = rr * bb - rb * rb
+    inv_gb = rb * rg - rr * gb
+    inv_bb = rr * gg - rg * rg
+    det = rr * inv_rr + rg * inv_rg + rb * inv_rb
+    cr, cg, cb = cov_ip[..., 0], cov_ip[..., 1], cov_ip[..., 2]
+    a = np.stack([
+        inv_rr * cr + inv_rg * cg + inv_rb * cb,
+        inv_rg * cr + inv_gg * cg + inv_gb * cb,
+        inv_rb * cr + inv_gb * cg + inv_bb * cb,
+    ], axis=-1) / det[..., np.newaxis]
+    b = mean_p - np.einsum("ijk,ijk->ij", a, mean_i)
+
+    return np.einsum("ijk,ijk->ij", box_filter(a, radius), image) + box_filter(b, radius)
+
+
+def estimate_alpha_guided(image, mask, trimap, radius, eps=GUIDED_EPS):
+    """Alpha for the unknown region of ``trimap`` from the model ``mask``.
+
+    ``image`` is an HxWx3 float array in [0, 1], ``mask`` and ``trimap``
+    uint8 arrays. The mask is binarized and filtered against the image, so
+    the image rather than the blurry upscaled mask decides where the edge
+    is and how soft it is; the known foreground and background of the
+    trimap are then kept as they are. ``radius`` should cover the
+    uncertainty of the mask edge. Only the bounding box of the unknown
+    region is filtered.
+    """
+    alpha = (trimap == 255).astype(np.float32)
+    unknown = trimap == 128
+    box = _crop(unknown, 2 * radius + 1)
+    if box is None:
+        return alpha
+
+    hard = (mask[box] > 127).astype(np.float32)
+    refined = np.clip(guided_filter(image[box].astype(np.float32), hard, radius, eps), 0, 1)
+    alpha[box][unknown[box]] = refined[unknown[box]]
+    return alpha
+
+
+def estimate_foreground_blur(image, alpha, radii=(90, 6)):
+    """Foreground colours by blur fusion (Germer et al., 2020).
+
+    A cheap stand-in for ``estimate_foreground_ml``: each pass re-estimates
+    the foreground and background as alpha-weighted local means, using box
+    filters of the given ``radii``, and corrects the foreground so that it
+    reproduces the image under ``alpha``. Fully opaque and transparent
+    pixels keep the image colour; only the box around the rest is solved.
+    """
+    image = image.astype(np.float32)
+    result = image.copy()
+    blended = (alpha > 0) & (alpha < 1)
+    box = _crop(blended, 2 * max(radii) + 1)
+    if box is None:
+        return result
+
+    alpha = alpha[box].astype(np.float32)[..., np.newaxis]
+    image = image[box]
+    foreground = image
+    background = image
+    for radius in radii:
+        weight_f = box_filter(alpha, radius)
+        weight_b = box_filter(1 - alpha, radius)
+        blur_f = box_filter(foreground * alpha, radius) / np.maximum(weight_f, 1e-5)
+        blur_b = box_filter(background * (1 - alpha), radius) / np.maximum(weight_b, 1e-5)
+        foreground = blur_f + alpha * (image - alpha * blur_f - (1 - alpha) * blur_b)
+        foreground = np.clip(foreground, 0, 1)
+        background = blur_b
+    result[box][blended[box]] = foreground[blended[box]]
+    return result
+
+
+def unknown_regions(trimap, margin=CROP_MARGIN):
+    """Split the unknown band of ``trimap`` into independent regions.
+
+    Unknown pixels closer than three pixels apart share a closed-form
+    matting window, so they are grouped together. Returns the label image
+    and one ``(box, label)`` pair per region, ``box`` being its bounding box
+    grown by ``margin``.
+    """
+    from scipy.ndimage import binary_dilation, find_objects, label
+
+    unknown = trimap == 128
+    labels, _ = label(binary_dilation(unknown, structure=np.ones((3, 3), dtype=bool)),
+                      structure=np.ones((3, 3), dtype=int))
+    labels[~unknown] = 0
+    regions = []
+    for index, box in enumerate(find_objects(labels), 1):
+        if box is not None:
+            regions.append((tuple(slice(max(s.start - margin, 0), s.stop + margin) for s in box), index))
+    return labels, regions
+
+
+def default_workers(workers=None):
+    """``workers``, else BACKGROUNDREMOVER_MATTING_WORKERS, else 1.
+
+    The pool is opt-in: its spawned processes re-import the calling script,
+    which without an ``if __name__ == "__main__":`` guard runs it again.
+    """
+    return workers or int(os.environ.get("BACKGROUNDREMOVER_MATTING_WORKERS", 0)) or 1
+
+
+def _imap(fn, jobs, workers):
+    """``fn(*job)`` for every job, in order, on ``workers`` processes.
+
+    At most two jobs per worker are submitted ahead, so only a few crops are
+    held at a time. Falls back to this process when the pool breaks.
+    """
+    jobs = iter(jobs)
+    if workers > 1:
+        pending, futures = collections.deque(), collections.deque()
+        try:
+            # spawn like the video workers, forking a process that runs torch is not safe
+            context = multiprocessing.get_context("spawn")
+            with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+                for job in itertools.chain(jobs, [None]):
+                    if job is not None:
+                        pending.append(job)
+                        futures.append(pool.submit(fn, *job))
+                    while futures and (job is None or len(futures) >= 2 * workers):
+                        result = futures[0].result()
+                        pending.popleft()
+                        futures.popleft()
+                        yield result
+            return
+        except BrokenProcessPool as e:
+            # e.g. a calling script without an ``if __name__ == "__main__"`` guard
+            print(f"Matting process pool failed, solving in this process instead: {e}")
+            jobs = itertools.chain(pending, jobs)
+    for job in jobs:
+        yield fn(*job)
+
+
+def _solve_cf(image, trimap):
+    # pymatting compiles its kernels with numba on import, only pay for it here
+    from pymatting.alpha.estimate_alpha_cf import estimate_alpha_cf
+    from pymatting.foreground.estimate_foreground_ml import estimate_foreground_ml
+
+    # a region bordered by only one side of the trimap is solved by that side alone
+    if not (trimap == 0).any():
+        return image, np.ones(trimap.shape)
+    if not (trimap == 255).any():
+        return image, np.zeros(trimap.shape)
+    alpha = estimate_alpha_cf(image, trimap / 255.0)
+    return estimate_foreground_ml(image, alpha), alpha
+
+
+def _solve_window(engine, image, mask, trimap, radius):
+    if engine == "cf":
+        # pymatting's kernels are compiled for float64 only
+        return _solve_cf(image.astype(np.float64), trimap)
+    alpha = estimate_alpha_guided(image, mask, trimap, radius)
+    return estimate_foreground_blur(image, alpha), alpha
+
+
+def estimate_cf(image, trimap, workers=None):
+    """Closed-form matting solved only around the unknown band of ``trimap``.
+
+    Each independent region of the band is cropped with a margin and solved
+    on its own, in a process pool when there are several large ones, then
+    stitched into a result that keeps the known pixels as they are. The
+    alpha matches solving the whole image, while memory and time follow the
+    size of the crops rather than of the image. ``workers`` defaults to
+    BACKGROUNDREMOVER_MATTING_WORKERS or 1, see ``default_workers``.
+    """
+    labels, regions = unknown_regions(trimap)
+    foreground = np.array(image, dtype=np.float64)
+    alpha = (trimap == 255).astype(np.float64)
+    if not regions:
+        return foreground, alpha
+
+    crops = [(image[box], trimap[box]) for box, _ in regions]
+    workers = min(default_workers(workers), len(regions))
+    if sum(t.size for _, t in crops) < POOL_MIN_PIXELS:
+        workers = 1
+
+    for (box, index), (crop_foreground, crop_alpha) in zip(regions, _imap(_solve_cf, crops, workers)):
+        region = labels[box] == index
+        alpha[box][region] = crop_alpha[region]
+        foreground[box][region] = crop_foreground[region]
+    return foreground, alpha
+
+
+def parse_memory(value):
+    """Bytes in ``value``, a number or a string like ``"512M"`` or ``"12G"``."""
+    if isinstance(value, str):
+        units = {"K": 2 ** 10, "M": 2 ** 20, "G": 2 ** 30, "T": 2 ** 40}
+        value = value.strip().upper().rstrip("B")
+        if value and value[-1] in units:
+            return int(float(value[:-1]) * units[value[-1]])
+    return int(float(value))
+
+
+def tile_plan(shape, engine, memory, workers=None):
+    """Tile side and number of workers that keep tiled matting within ``memory`` bytes."""
+    available = memory - shape[0] * shape[1] * TILED_BYTES_PER_PIXEL
+
+    def window(side):
+        return (side + 2 * TILE_OVERLAP) ** 2 * BYTES_PER_PIXEL[engine]
+
+    if available < window(MIN_TILE):
+        print(f"Matting memory budget of {memory / 2 ** 30:.1f} GB is too small for a "
+              f"{shape[1]}x{shape[0]} image, using the smallest tiles on one worker")
+        return MIN_TILE, 1
+    # larger tiles first, then more processes, each of which costs WORKER_BYTES on its own
+    workers = min(default_workers(workers), available // (window(POOL_TILE) + WORKER_BYTES))
+    if workers > 1:
+        available = available / workers - WORKER_BYTES
+    workers = max(workers, 1)
+    side = int((available / BYTES_PER_PIXEL[engine]) ** 0.5) - 2 * TILE_OVERLAP
+    return min(max(side, MIN_TILE), MAX_TILE), workers
+
+
+def boundary_tiles(trimap, tile, overlap=TILE_OVERLAP):
+    """Windows of a ``tile`` grid whose core holds unknown pixels, grown by ``overlap``."""
+    height, width = trimap.shape
+    unknown = trimap == 128
+    windows = []
+    for top in range(0, height, tile):
+        for left in range(0, width, tile):
+            if unknown[top:top + tile, left:left + tile].any():
+                windows.append((slice(max(top - overlap, 0), min(top + tile + overlap, height)),
+                                slice(max(left - overlap, 0), min(left + tile + overlap, width))))
+    return windows
+
+
+def _feather(window, shape, overlap=TILE_OVERLAP):
+    # on every side that has a neighbour, the outer half of the overlap is
+    # context only (alpha near a cut is poorly constrained) and the weight
+    # ramps up linearly across the next ``overlap`` pixels, crossing the
+    # neighbour's ramp at the tile border
+    ramps = []
+    for s, n in zip(window, shape):
+        length = s.stop - s.start
+        ramp = np.ones(length, dtype=np.float32)
+        fade = np.clip((np.arange(length, dtype=np.float32) + 0.5 - overlap / 2) / overlap, 0, 1)
+        if s.start > 0:
+            ramp = np.minimum(ramp, fade)
+        if s.stop < n:
+            ramp = np.minimum(ramp, fade[::-1])
+        ramps.append(ramp)
+    return ramps[0][:, np.newaxis] * ramps[1]
+
+
+def estimate_tiled(image, mask, trimap, engine="cf", radius=5, memory=8 * 2 ** 30, workers=None):
+    """Matting at full resolution in overlapping tiles along the unknown band.
+
+    Only tiles of the grid that contain unknown pixels are solved, each
+    with ``TILE_OVERLAP`` pixels of context, on a process pool. Tile size and
+    pool size are picked so that this step stays within ``memory`` bytes.
+    Tiles are blended with linear weights across their overlap, so seams do
+    not show. ``image`` is an HxWx3 float32 array in [0, 1]. Returns float32
+    foreground colours and alpha like ``estimate``.
+    """
+    tile, workers = tile_plan(trimap.shape, engine, memory, workers)
+    windows = boundary_tiles(trimap, tile)
+    workers = min(workers, max(len(windows), 1))
+
+    alpha = np.zeros(trimap.shape, dtype=np.float32)
+    foreground = np.zeros(image.shape, dtype=np.float32)
+    weight = np.zeros(trimap.shape, dtype=np.float32)
+
+    jobs = ((engine, image[window], mask[window], trimap[window], radius) for window in windows)
+    for window, (window_foreground, window_alpha) in zip(windows, _imap(_solve_window, jobs, workers)):
+        w = _feather(window, trimap.shape)
+        alpha[window] += window_alpha * w
+        foreground[window] += window_foreground * w[..., np.newaxis]
+        weight[window] += w
+
+    unknown = trimap == 128
+    np.divide(alpha, weight, out=alpha, where=unknown)
+    np.divide(foreground, weight[..., np.newaxis], out=foreground, where=unknown[..., np.newaxis])
+    np.copyto(alpha, trimap == 255, where=~unknown)
+    np.copyto(foreground, image, where=~unknown[..., np.newaxis])
+    return foreground, alpha
+
+
+def estimate(image, mask, trimap, engine="cf", radius=5, workers=None):
+    """Foreground colours and alpha, both in [0, 1], with the matting ``engine``.
+
+    ``image`` is an HxWx3 float array in [0, 1], ``mask`` the uint8 model
+    mask and ``trimap`` the result of ``trimap()`` at the same size.
+    ``radius`` is the guided filter radius, unused by ``cf``, and
+    ``workers`` caps the processes ``cf`` may use.
+    """
+    if engine == "guided":
+        alpha = estimate_alpha_guided(image, mask, trimap, radius)
+        return estimate_foreground_blur(image, alpha), alpha
+    if engine == "cf":
+        return estimate_cf(image, trimap, workers)
+    raise ValueError(f"Unknown matting engine {engine!r}, expected one of {MATTING_ENGINES}")
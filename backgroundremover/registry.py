@@ -0,0 +1,179 @@
+import io
+import os
+import threading
+from collections import OrderedDict
+
+import torch
+
+from . import backends
+from .u2net import detect, optimize
+
+
+def _default_budget():
+    """Read the cache budget (in MB) from BACKGROUNDREMOVER_MODEL_CACHE_MB.
+
+    ``0`` or a negative value disables the limit.
+    """
+    try:
+        budget_mb = int(os.environ.get("BACKGROUNDREMOVER_MODEL_CACHE_MB", 1024))
+    except ValueError:
+        budget_mb = 1024
+    if budget_mb <= 0:
+        return None
+    return budget_mb * 1024 * 1024
+
+
+def model_bytes(net):
+    """Size in bytes of the parameters and buffers held by ``net``."""
+    if isinstance(net, backends.OnnxModel):
+        return os.path.getsize(net.path)
+    if isinstance(net, torch.jit.ScriptModule):
+        # quantized weights are packed objects that state_dict() leaves out
+        buffer = io.BytesIO()
+        torch.jit.save(net, buffer)
+        return buffer.tell()
+    return sum(t.numel() * t.element_size() for t in net.state_dict().values())
+
+
+class ModelRegistry(object):
+    """Process-wide cache of loaded models keyed by (model_name, device, dtype, backend).
+
+    ``dtype`` is a torch floating point dtype, or ``"int8"`` for the
+    quantized CPU model built by ``optimize.load_int8``. ``backend`` is
+    ``"torch"`` or ``"onnx"`` (onnxruntime on the CPU).
+
+    Entries are kept in least-recently-used order. When the combined size of
+    the cached weights exceeds ``max_bytes`` the oldest entries are evicted,
+    except for the model that was just requested.
+    """
+
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes
+        self._models = OrderedDict()
+        self._sizes = {}
+        self._lock = threading.Lock()
+        self._load_locks = {}
+
+    @staticmethod
+    def key(model_name, device=None, dtype=torch.float32, backend="torch"):
+        if backend not in backends.BACKENDS:
+            raise ValueError(f"Unknown backend {backend!r}, expected one of {backends.BACKENDS}")
+        if backend == "onnx" and dtype == "int8":
+            raise ValueError("int8 quantization is only available with the torch backend")
+        if dtype == "int8" or backend == "onnx":
+            # quantized kernels and the onnxruntime session only run on the CPU
+            device = "cpu"
+        if device is None:
+            device = detect.default_device()
+        return model_name, str(torch.device(device)), str(dtype), backend
+
+    def get(self, model_name, device=None, dtype=torch.float32, backend="torch"):
+        key = self.key(model_name, device, dtype, backend)
+
+        with self._lock:
+            if key in self._models:
+                self._models.move_to_end(key)
+                return self._models[key]
+            load_lock = self._load_locks.setdefault(key, threading.Lock())
+
+        # load outside the registry lock so other models stay available, but
+        # only once per key when several threads ask for the same model
+        with load_lock:
+            with self._lock:
+                if key in self._models:
+                    self._models.move_to_end(key)
+                    return self._models[key]
+
+            if backend == "onnx":
+                net = backends.load_onnx(model_name)
+            elif dtype == "int8":
+                net = optimize.load_int8(model_name)
+            else:
+                net = detect.load_model(model_name=model_name, device=key[1], inference_only=True)
+                net.to(dtype=dtype)
+                optimize.optimize_for_inference(net)
+
+            with self._lock:
+                self._models[key] = net
+                self._sizes[key] = model_bytes(net)
+                self._load_locks.pop(key, None)
+                self._enforce_budget(keep=key)
+            return net
+
+    def add(self, net, model_name, device=None, dtype=torch.float32, backend="torch"):
+        """Register an already loaded model, e.g. one built around shared weights."""
+        key = self.key(model_name, device, dtype, backend)
+        with self._lock:
+            self._models[key] = net
+            self._sizes[key] = model_bytes(net)
+            self._enforce_budget(keep=key)
+        return net
+
+    def preload(self, model_names, device=None, dtype=torch.float32, backend="torch"):
+        if isinstance(model_names, str):
+            model_names = [model_names]
+        for model_name in model_names:
+            self.get(model_name, device, dtype, backend)
+
+    def evict(self, model_name=None, device=None, dtype=None, backend=None):
+        """Drop cached models matching the given fields; ``None`` matches any."""
+        evicted = 0
+        with self._lock:
+            for key in list(self._models):
+                name, dev, dt, be = key
+                if model_name is not None and name != model_name:
+                    continue
+                if device is not None and dev != str(torch.device(device)):
+                    continue
+                if dtype is not None and dt != str(dtype):
+                    continue
+                if backend is not None and be != backend:
+                    continue
+                del self._models[key]
+                del self._sizes[key]
+                evicted += 1
+        if evicted and torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        return evicted
+
+    def clear(self):
+        return self.evict()
+
+    def cached(self):
+        with self._lock:
+            return list(self._models)
+
+    def total_bytes(self):
+        with self._lock:
+            return sum(self._sizes.values())
+
+    def set_budget(self, max_bytes):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._enforce_budget()
+
+    def _enforce_budget(self, keep=None):
+        if self.max_bytes is None:
+            return
+        for key in list(self._models):
+            if sum(self._sizes.values()) <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            del self._models[key]
+            del self._sizes[key]
+
+
+REGISTRY = ModelRegistry(max_bytes=_default_budget())
+
+
+def get_model(model_name="u2net", device=None, dtype=torch.float32, backend="torch"):
+    return REGISTRY.get(model_name, device, dtype, backend)
+
+
+def preload(model_names, device=None, dtype=torch.float32, backend="torch"):
+    REGISTRY.preload(model_names, device, dtype, backend)
+
+
+def evict(model_name=None, device=None, dtype=None, backend=None):
+    return REGISTRY.evict(model_name, device, dtype, backend)
@@ -1,90 +1,111 @@
 import errno
+import inspect
 import os
 import sys
+import tempfile
 import numpy as np
 import torch
-from hsh.library.hash import Hasher
 from PIL import Image
-from torchvision import transforms
 
-from . import data_loader, u2net
+from . import u2net
 from .. import github
 
 
-def load_model(model_name: str = "u2net"):
-    hasher = Hasher()
-
-    model = {
-        'u2netp': (u2net.U2NETP,
-                   'e4f636406ca4e2af789941e7f139ee2e',
-                   '1rbSTGKAE-MTxBYHd-51l2hMOQPT_7EPy',
-                   'U2NET_PATH'),
-        'u2net': (u2net.U2NET,
-                  '09fb4e49b7f785c9f855baf94916840a',
-                  '1ao1ovG1Qtx4b7EoskHXmi2E9rp5CHLcZ',
-                  'U2NET_PATH'),
-        'u2net_human_seg': (u2net.U2NET,
-                            '347c3d51b01528e5c6c071e3cff1cb55',
-                            '1-Yg0cxgrNhHP-016FPdp902BR-kSsA4P',
-                            'U2NET_PATH')
-    }[model_name]
+def default_device():
+    return torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
+
+def model_path(model_name):
+    """Location of the ``.pth`` weights for ``model_name``, as used by load_model."""
+    return os.environ.get(
+        "U2NETP_PATH" if model_name == "u2netp" else "U2NET_PATH",
+        os.path.expanduser(os.path.join("~", ".u2net", model_name + ".pth")),
+    )
+
+
+def build_model(model_name="u2net", inference_only=False):
+    """The untrained network for ``model_name``, without loading weights."""
     if model_name == "u2netp":
-        net = u2net.U2NETP(3, 1)
-        path = os.environ.get(
-            "U2NETP_PATH",
-            os.path.expanduser(os.path.join("~", ".u2net", model_name + ".pth")),
-        )
-        if (
-            not os.path.exists(path)
-            #or hasher.md5(path) != "e4f636406ca4e2af789941e7f139ee2e"
-        ):
-            github.download_files_from_github(
-                path, model_name
-            )
-
-    elif model_name == "u2net":
-        net = u2net.U2NET(3, 1)
-        path = os.environ.get(
-            "U2NET_PATH",
-            os.path.expanduser(os.path.join("~", ".u2net", model_name + ".pth")),
-        )
-        if (
-            not os.path.exists(path)
-            #or hasher.md5(path) != "09fb4e49b7f785c9f855baf94916840a"
-        ):
-            github.download_files_from_github(
-                path, model_name
-            )
-
-    elif model_name == "u2net_human_seg":
-        net = u2net.U2NET(3, 1)
-        path = os.environ.get(
-            "U2NET_PATH",
-            os.path.expanduser(os.path.join("~", ".u2net", model_name + ".pth")),
-        )
-        if (
-            not os.path.exists(path)
-            #or hasher.md5(path) != "347c3d51b01528e5c6c071e3cff1cb55"
-        ):
-            github.download_files_from_github(
-                path, model_name
-            )
+        return u2net.U2NETP(3, 1, inference_only=inference_only)
+    return u2net.U2NET(3, 1, inference_only=inference_only)
 
-    else:
+
+def _umask():
+    # os.umask can only be read by setting it, so read it from /proc where possible
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("Umask:"):
+                    return int(line.split()[1], 8)
+    except OSError:
+        pass
+    umask = os.umask(0o022)
+    os.umask(umask)
+    return umask
+
+
+def save_atomic(path, save):
+    """Write ``path`` by calling ``save`` with a temporary path next to it.
+
+    The file is moved into place only once it is complete, so concurrent
+    readers and crashed writers never leave a partial file behind. It gets
+    the permissions of a normally created file rather than mkstemp's 0600,
+    so caches in a shared directory work for other users.
+    """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+    os.close(fd)
+    try:
+        save(tmp)
+        os.chmod(tmp, 0o666 & ~_umask())
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+
+def assign_supported():
+    """Whether this torch can adopt loaded tensors without a copy (2.1 and later)."""
+    return "assign" in inspect.signature(torch.nn.Module.load_state_dict).parameters
+
+
+WEIGHTS_MD5 = {
+    'u2netp': 'e4f636406ca4e2af789941e7f139ee2e',
+    'u2net': '09fb4e49b7f785c9f855baf94916840a',
+    'u2net_human_seg': '347c3d51b01528e5c6c071e3cff1cb55',
+}
+
+
+def ensure_weights(model_name):
+    """Path of the ``.pth`` weights for ``model_name``, downloaded first if missing."""
+    path = model_path(model_name)
+    if not os.path.exists(path):
+        github.download_files_from_github(path, model_name, md5=WEIGHTS_MD5[model_name])
+    return path
+
+
+def load_model(model_name: str = "u2net", device=None, inference_only=False):
+    if model_name not in WEIGHTS_MD5:
         print("Choose between u2net, u2net_human_seg or u2netp", file=sys.stderr)
+        raise KeyError(model_name)
+    path = ensure_weights(model_name)
+
+    if device is None:
+        device = default_device()
 
     try:
-        if torch.cuda.is_available():
-            net.load_state_dict(torch.load(path))
-            net.to(torch.device("cuda"))
+        state = torch.load(path, map_location="cpu")
+        if assign_supported():
+            # build without allocating weights and adopt the loaded tensors as they are
+            with torch.device("meta"):
+                net = build_model(model_name, inference_only)
+            net.load_state_dict(state, assign=True)
         else:
-            net.load_state_dict(
-                torch.load(
-                    path,
-                    map_location="cpu",
-                )
-            )
+            net = build_model(model_name, inference_only)
+            net.load_state_dict(state)
+        net.to(device)
     except FileNotFoundError:
         raise FileNotFoundError(
             errno.ENOENT, os.strerror(errno.ENOENT), model_name + ".pth"
@@ -139,6 +160,10 @@ def preprocess(image):
         image = image[:, :, np.newaxis]
         label = label[:, :, np.newaxis]
 
+    # the training-time pipeline needs torchvision and scikit-image
+    from torchvision import transforms
+    from . import data_loader
+
     transform = transforms.Compose(
         [data_loader.RescaleT(320), data_loader.ToTensorLab(flag=0)]
     )
@@ -147,28 +172,153 @@ def preprocess(image):
     return sample
 
 
-def predict(net, item):
-    sample = preprocess(item)
+# ImageNet statistics used by ToTensorLab(flag=0)
+MEAN = np.array([0.485, 0.456, 0.406], dtype=np.float32)
+STD = np.array([0.229, 0.224, 0.225], dtype=np.float32)
+
+
+def _resize_weights(n, size):
+    """(size, n) matrix of skimage's anti-aliased bilinear resize along one axis.
+
+    ``transform.resize(..., mode="constant")`` blurs with a Gaussian of sigma
+    ``(n / size - 1) / 2`` and then samples bilinearly, both with zeros past
+    the edges; both are linear, so they fold into one matrix per axis.
+    """
+    x = (np.arange(size) + 0.5) * n / size - 0.5
+    left = np.floor(x).astype(np.int64)
+    frac = x - left
+    # one column of padding either side takes the samples that fall past the edges
+    weights = np.zeros((size, n + 2))
+    rows = np.arange(size)
+    np.add.at(weights, (rows, left + 1), 1 - frac)
+    np.add.at(weights, (rows, left + 2), frac)
+    weights = weights[:, 1:-1]
+
+    sigma = max(0.0, (n / size - 1) / 2)
+    if sigma > 0:
+        # scipy.ndimage.gaussian_filter's kernel, truncated at 4 sigma
+        radius = int(4.0 * sigma + 0.5)
+        kernel = np.exp(-0.5 * (np.arange(-radius, radius + 1) / sigma) ** 2)
+        kernel /= kernel.sum()
+        blurred = np.zeros_like(weights)
+        for shift, k in zip(range(-radius, radius + 1), kernel):
+            if shift >= 0:
+                blurred[:, shift:] += k * weights[:, :n - shift]
+            else:
+                blurred[:, :shift] += k * weights[:, -shift:]
+        weights = blurred
+    return weights.astype(np.float32)
+
+
+def _resize(image, size):
+    """``transform.resize(image, (size, size), mode="constant")`` without the 0-1 scaling, as float32."""
+    height, width = image.shape[:2]
+    rows, cols = _resize_weights(height, size), _resize_weights(width, size)
+    flat = image.reshape(height, -1)
+    # each output row only reads the band of input rows its weights cover,
+    # so the full image is never converted to float at once
+    nonzero = rows != 0
+    first, last = nonzero.argmax(1), height - nonzero[:, ::-1].argmax(1)
+    tall = np.empty((size, flat.shape[1]), dtype=np.float32)
+    for i in range(size):
+        tall[i] = rows[i, first[i]:last[i]] @ flat[first[i]:last[i]].astype(np.float32)
+    tall = tall.reshape(size, width, -1)
+    return np.tensordot(tall, cols, axes=([1], [1])).transpose(0, 2, 1)
+
+
+def preprocess_image(image, size=320):
+    """Resize and normalize a uint8 image into a float32 CxHxW tensor.
+
+    Inference-only replacement for ``preprocess``: the same anti-aliased
+    resize as ``RescaleT`` (to float32 rounding) is applied one band of rows
+    at a time, and normalization is a single multiply-add per channel, as
+    ``ToTensorLab(flag=0)`` does it.
+    """
+    if image.ndim == 3 and image.shape[2] == 1:
+        image = image[:, :, 0]
+
+    resized = np.ascontiguousarray(_resize(image, size))
+
+    if image.ndim == 2:
+        resized = np.repeat(resized, 3, axis=2)
+        mean, std = MEAN[:1], STD[:1]
+    else:
+        mean, std = MEAN, STD
+
+    # ToTensorLab scales by the maximum of the resized image, not by 255
+    peak = max(float(resized.max()), 1e-6)
+    resized *= 1.0 / (peak * std)
+    resized -= mean / std
+
+    return torch.from_numpy(np.ascontiguousarray(resized.transpose((2, 0, 1))))
+
+
+def model_device(net):
+    """Device and dtype the inputs of ``net`` should have."""
+    for param in net.parameters():
+        if param.is_floating_point():
+            return param.device, param.dtype
+    # quantized models keep their weights in packed, non-parameter form
+    return torch.device("cpu"), torch.float32
+
+
+def predict_mask(net, item, inference_size=320):
+    """The mask of ``item`` as a float32 array in [0, 1] at model resolution."""
+    sample = preprocess_image(item, inference_size)
 
     with torch.no_grad():
 
-        if torch.cuda.is_available():
-            inputs_test = torch.cuda.FloatTensor(
-                sample["image"].unsqueeze(0).cuda().float()
-            )
-        else:
-            inputs_test = torch.FloatTensor(sample["image"].unsqueeze(0).float())
+        device, dtype = model_device(net)
+        inputs_test = sample.unsqueeze(0).to(device=device, dtype=dtype)
+        if getattr(net, "channels_last", False):
+            inputs_test = inputs_test.contiguous(memory_format=torch.channels_last)
 
-        d1, d2, d3, d4, d5, d6, d7 = net(inputs_test)
+        d1 = net(inputs_test)[0]
 
         pred = d1[:, 0, :, :]
         predict = norm_pred(pred)
 
         predict = predict.squeeze()
-        predict_np = predict.cpu().detach().numpy()
-        img = Image.fromarray(predict_np * 255).convert("RGB")
+        predict_np = predict.float().cpu().detach().numpy()
 
-        del d1, d2, d3, d4, d5, d6, d7, pred, predict, predict_np, inputs_test, sample
+        del d1, pred, predict, inputs_test, sample
         torch.cuda.empty_cache() if torch.cuda.is_available() else None
 
-        return img
+        return predict_np
+
+
+def predict(net, item, inference_size=320):
+    return Image.fromarray(predict_mask(net, item, inference_size) * 255).convert("RGB")
+
+
+def predict_mask_batch(net, items, inference_size=320):
+    """Run several images through ``net`` in a single forward pass.
+
+    Each prediction is normalized on its own, so the masks match what
+    ``predict_mask`` returns for the same images one at a time.
+    """
+    samples = [preprocess_image(item, inference_size) for item in items]
+
+    with torch.no_grad():
+
+        device, dtype = model_device(net)
+        inputs_test = torch.stack(samples).to(device=device, dtype=dtype)
+        if getattr(net, "channels_last", False):
+            inputs_test = inputs_test.contiguous(memory_format=torch.channels_last)
+
+        pred = net(inputs_test)[0][:, 0, :, :]
+        ma = torch.amax(pred, dim=(1, 2), keepdim=True)
+        mi = torch.amin(pred, dim=(1, 2), keepdim=True)
+        predict = (pred - mi) / (ma - mi)
+
+        predict_np = predict.float().cpu().detach().numpy()
+
+        del pred, predict, inputs_test, samples
+        torch.cuda.empty_cache() if torch.cuda.is_available() else None
+
+        return list(predict_np)
+
+
+def predict_batch(net, items, inference_size=320):
+    """``predict_mask_batch`` as RGB images, like ``predict``."""
+    return [Image.fromarray(p * 255).convert("RGB") for p in predict_mask_batch(net, items, inference_size)]
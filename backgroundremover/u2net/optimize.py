@@ -0,0 +1,219 @@
+import copy
+import os
+import warnings
+
+import numpy as np
+import torch
+
+from . import detect, u2net
+
+
+def fuse_rebnconv(net):
+    """Fuse the conv, batch norm and ReLU of every REBNCONV block in place.
+
+    The model must be in eval mode; batch norm is folded into the conv
+    weights and the block runs as a single conv+ReLU module.
+    """
+    from torch.ao.quantization import fuse_modules
+
+    for module in net.modules():
+        if isinstance(module, u2net.REBNCONV) and isinstance(module.bn_s1, torch.nn.BatchNorm2d):
+            fuse_modules(module, [["conv_s1", "bn_s1", "relu_s1"]], inplace=True)
+    return net
+
+
+def fold_batchnorm(net):
+    """Fold the batch norm of every REBNCONV block into its conv weights.
+
+    Only valid in eval mode, where batch norm is a fixed per-channel affine
+    transform. The folded blocks keep their structure, with ``bn_s1``
+    replaced by an identity.
+    """
+    from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+    for module in net.modules():
+        if isinstance(module, u2net.REBNCONV) and isinstance(module.bn_s1, torch.nn.BatchNorm2d):
+            module.conv_s1 = fuse_conv_bn_eval(module.conv_s1, module.bn_s1)
+            module.bn_s1 = torch.nn.Identity()
+    return net
+
+
+def optimize_for_inference(net, channels_last=None):
+    """One-time graph optimization applied when an engine is loaded.
+
+    Folds batch norm into the convolutions and, on CPU and CUDA, switches
+    the weights to the channels_last layout so oneDNN/cuDNN pick their
+    NHWC kernels. Inputs should then be passed as channels_last as well;
+    ``net.channels_last`` records whether that is the case.
+    """
+    net.eval()
+    fold_batchnorm(net)
+    if channels_last is None:
+        param = next(net.parameters())
+        channels_last = param.device.type in ("cpu", "cuda")
+    if channels_last:
+        net.to(memory_format=torch.channels_last)
+    net.channels_last = channels_last
+    return net
+
+
+# torch.multiprocessing shares CPU tensors through shared memory and CUDA
+# tensors through IPC handles; other devices (MPS, ...) cannot be sent
+SHAREABLE_DEVICES = ("cpu", "cuda")
+
+
+def share_weights(net):
+    """Move the weights of ``net`` into one block other processes can map.
+
+    Parameters and buffers are copied into a single flat tensor (shared
+    memory on the CPU, a CUDA IPC handle on the GPU) and ``net`` is rebound
+    to views of it, so the process keeps one copy. Returns ``(flat, layout)``,
+    which pickles cheaply through ``torch.multiprocessing`` and is turned
+    back into tensors with ``shared_state``.
+    """
+    if getattr(net, "shared_weights", None) is not None:
+        return net.shared_weights
+    state = net.state_dict()
+    dtype = next(iter(state.values())).dtype
+    device = next(iter(state.values())).device
+    if any(t.dtype != dtype for t in state.values()):
+        raise ValueError("share_weights needs all weights in one dtype")
+    if device.type not in SHAREABLE_DEVICES:
+        raise ValueError(f"share_weights cannot share {device.type} tensors between processes")
+
+    flat = torch.empty(sum(t.numel() for t in state.values()), dtype=dtype, device=device)
+    if device.type == "cpu":
+        flat.share_memory_()
+    layout = []
+    offset = 0
+    for name, t in state.items():
+        layout.append((name, tuple(t.shape), tuple(t.stride()), offset))
+        offset += t.numel()
+    weights = (flat, layout, getattr(net, "channels_last", False))
+    with torch.no_grad():
+        for name, t in shared_state(weights).items():
+            t.copy_(state[name])
+    bind_weights(net, shared_state(weights))
+    net.shared_weights = weights
+    return weights
+
+
+def shared_state(weights):
+    """State dict of views into the block returned by ``share_weights``."""
+    flat, layout = weights[:2]
+    return {name: flat.as_strided(shape, stride, offset) for name, shape, stride, offset in layout}
+
+
+def bind_weights(module, state, prefix=""):
+    """Point the parameters and buffers of ``module`` at the tensors in ``state``.
+
+    Unlike ``load_state_dict`` nothing is copied, and it also works on
+    TorchScript modules. ``prefix`` is prepended to the names looked up in
+    ``module``.
+    """
+    for name, tensor in state.items():
+        *path, attr = (prefix + name).split(".")
+        owner = module
+        for part in path:
+            owner = getattr(owner, part)
+        if isinstance(getattr(owner, attr), torch.nn.Parameter):
+            tensor = torch.nn.Parameter(tensor, requires_grad=False)
+        setattr(owner, attr, tensor)
+    return module
+
+
+def attach_weights(model_name, weights):
+    """Build an inference engine for ``model_name`` around shared weights.
+
+    The model is created on the meta device, so building it allocates no
+    weight memory of its own, then bound to the views of ``weights``.
+    """
+    with torch.device("meta"):
+        net = detect.build_model(model_name, inference_only=True)
+    optimize_for_inference(net, channels_last=False)
+    bind_weights(net, shared_state(weights))
+    net.channels_last = weights[2]
+    return net
+
+
+def quantized_engine():
+    engines = torch.backends.quantized.supported_engines
+    for engine in ("x86", "fbgemm", "qnnpack"):
+        if engine in engines:
+            return engine
+    raise RuntimeError("This PyTorch build has no int8 quantization engine")
+
+
+def calibration_inputs(images=None, inference_size=320, count=8):
+    """Model inputs used to calibrate activation ranges.
+
+    ``images`` is a list of uint8 RGB arrays; when omitted, synthetic
+    images (smooth colour fields with a solid subject) are used instead.
+    """
+    if images is None:
+        rng = np.random.default_rng(0)
+        images = []
+        for _ in range(count):
+            img = rng.integers(0, 256, size=(8, 8, 3), dtype=np.uint8)
+            img = np.repeat(np.repeat(img, 40, axis=0), 40, axis=1)
+            top, left = rng.integers(40, 160, size=2)
+            img[top:top + 120, left:left + 120] = rng.integers(0, 256, size=3, dtype=np.uint8)
+            images.append(img)
+    return [detect.preprocess_image(img, inference_size).unsqueeze(0) for img in images]
+
+
+def quantize_int8(net, images=None, inference_size=320):
+    """Return a statically quantized int8 copy of a U2NET/U2NETP model.
+
+    Convolutions in REBNCONV blocks are fused with their batch norm and
+    ReLU before quantization. PyTorch's dynamic quantization only covers
+    linear and recurrent layers, so activation ranges are calibrated on
+    ``images`` (or synthetic ones) instead. The result only runs on CPU.
+    """
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+    engine = quantized_engine()
+    torch.backends.quantized.engine = engine
+
+    net = copy.deepcopy(net).to(device="cpu", dtype=torch.float32).eval()
+    fuse_rebnconv(net)
+    inputs = calibration_inputs(images, inference_size)
+
+    with warnings.catch_warnings(), torch.no_grad():
+        warnings.simplefilter("ignore")
+        prepared = prepare_fx(net, get_default_qconfig_mapping(engine), example_inputs=(inputs[0],))
+        for x in inputs:
+            prepared(x)
+        quantized = convert_fx(prepared)
+        return torch.jit.trace(quantized, inputs[0])
+
+
+def quantized_path(model_path):
+    return os.path.splitext(model_path)[0] + ".int8.pt"
+
+
+def load_int8(model_name="u2net", images=None):
+    """Load the int8 model for ``model_name``, quantizing it on first use.
+
+    The quantized TorchScript module is cached next to the ``.pth`` weights
+    and rebuilt whenever the weights file is newer than the cache.
+    """
+    weights = detect.ensure_weights(model_name)
+    path = quantized_path(weights)
+    torch.backends.quantized.engine = quantized_engine()
+
+    if os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(weights):
+        try:
+            return torch.jit.load(path, map_location="cpu").eval()
+        except Exception as e:
+            print(f"Ignoring unreadable quantized model cache {path}: {e}")
+
+    print(f"Quantizing {model_name} to int8 (one-time, cached at {path})")
+    net = detect.load_model(model_name, device="cpu", inference_only=True)
+    quantized = quantize_int8(net, images)
+    try:
+        detect.save_atomic(path, lambda tmp: torch.jit.save(quantized, tmp))
+    except OSError as e:
+        print(f"Could not cache quantized model at {path}: {e}")
+    return quantized.eval()
@@ -1,7 +1,6 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from torchvision import models
 
 
 class REBNCONV(nn.Module):
@@ -319,9 +318,12 @@ class RSU4F(nn.Module):  # UNet04FRES(nn.Module):
 
 ##### U^2-Net ####
 class U2NET(nn.Module):
-    def __init__(self, in_ch=3, out_ch=1):
+    def __init__(self, in_ch=3, out_ch=1, inference_only=False):
         super(U2NET, self).__init__()
 
+        # when set, forward() returns only the fused saliency map
+        self.inference_only = inference_only
+
         self.stage1 = RSU7(in_ch, 32, 64)
         self.pool12 = nn.MaxPool2d(2, stride=2, ceil_mode=True)
 
@@ -418,6 +420,9 @@ class U2NET(nn.Module):
 
         d0 = self.outconv(torch.cat((d1, d2, d3, d4, d5, d6), 1))
 
+        if self.inference_only:
+            return (torch.sigmoid(d0),)
+
         return (
             torch.sigmoid(d0),
             torch.sigmoid(d1),
@@ -431,9 +436,12 @@ class U2NET(nn.Module):
 
 ### U^2-Net small ###
 class U2NETP(nn.Module):
-    def __init__(self, in_ch=3, out_ch=1):
+    def __init__(self, in_ch=3, out_ch=1, inference_only=False):
         super(U2NETP, self).__init__()
 
+        # when set, forward() returns only the fused saliency map
+        self.inference_only = inference_only
+
         self.stage1 = RSU7(in_ch, 16, 64)
         self.pool12 = nn.MaxPool2d(2, stride=2, ceil_mode=True)
 
@@ -530,6 +538,9 @@ class U2NETP(nn.Module):
 
         d0 = self.outconv(torch.cat((d1, d2, d3, d4, d5, d6), 1))
 
+        if self.inference_only:
+            return (torch.sigmoid(d0),)
+
         return (
             torch.sigmoid(d0),
             torch.sigmoid(d1),
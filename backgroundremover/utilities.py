@@ -1,18 +1,25 @@
+import itertools
 import os
-import math
+import queue
+import traceback
 from fractions import Fraction
-import torch.multiprocessing as multiprocessing
+import torch.multiprocessing
 import subprocess as sp
-import time
 import ffmpeg
 import numpy as np
 import torch
-from .bg import DEVICE, Net, iter_frames, remove_many
+from .bg import Net, inference_device, remove_many
+from . import backends, compile_cache, registry
+from .framering import FrameRing
+from .framesource import FrameSource
+from .u2net import optimize
 import tempfile
 import requests
 from pathlib import Path
 
-multiprocessing.set_start_method('spawn', force=True)
+# CUDA cannot be used from forked workers; take a spawn context rather than
+# changing the global start method for whoever imports this module
+multiprocessing = torch.multiprocessing.get_context('spawn')
 
 
 def _parse_frame_rate(rate_str):
@@ -52,51 +59,90 @@ def _alpha_encoding_args(output, alpha_codec, alpha_pix_fmt):
     return args
 
 
-def worker(worker_nodes,
-           worker_index,
-           result_dict,
+def worker(worker_index,
+           ring,
+           batches,
+           done,
            model_name,
-           gpu_batchsize,
-           total_frames,
-           frames_dict):
+           inference_size=320,
+           quantize=None,
+           backend="torch",
+           weights=None):
     print(F"WORKER {worker_index} ONLINE")
-
-    output_index = worker_index + 1
-    base_index = worker_index * gpu_batchsize
-    net = Net(model_name)
-    script_net = None
-    for fi in (list(range(base_index + i * worker_nodes * gpu_batchsize,
-                          min(base_index + i * worker_nodes * gpu_batchsize + gpu_batchsize, total_frames)))
-               for i in range(math.ceil(total_frames / worker_nodes / gpu_batchsize))):
-        if not fi:
-            break
-
-        # are we processing frames faster than the frame ripper is saving them?
-        last = fi[-1]
-        while last not in frames_dict:
-            time.sleep(0.1)
-
-        input_frames = [frames_dict[index] for index in fi]
-        if script_net is None:
-            script_net = torch.jit.trace(net,
-                                         torch.as_tensor(np.stack(input_frames), dtype=torch.float32, device=DEVICE))
-
-        result_dict[output_index] = remove_many(input_frames, script_net)
-
-        # clean up the frame buffer
-        for fdex in fi:
-            del frames_dict[fdex]
-        output_index += worker_nodes
+    try:
+        device = inference_device(quantize, backend)
+        if weights is not None:
+            # use the parent's copy of the weights instead of loading our own
+            registry.REGISTRY.add(optimize.attach_weights(model_name, weights), model_name, device=device)
+        script_net = None
+        # blocks until the frame ripper has a whole batch in the ring, None means it is done
+        for start, count in iter(batches.get, None):
+            indices = range(start, start + count)
+            input_frames = [ring.frames[ring.slot(index)] for index in indices]
+            if script_net is None and backend == "onnx":
+                # onnxruntime runs its own optimized graph and cannot be traced
+                script_net = Net(model_name, inference_size, quantize, backend)
+            elif script_net is None:
+                script_net = compile_cache.load_traced(
+                    model_name,
+                    torch.as_tensor(np.stack(input_frames), dtype=torch.float32, device=device),
+                    inference_size,
+                    quantize,
+                )
+
+            # the masks go in the frames' slots
+            ring.put_masks(indices, remove_many(input_frames, script_net, device))
+            done.put(("masks", start, count))
+    except Exception:
+        done.put(("error", F"worker {worker_index}", traceback.format_exc()))
+    finally:
+        ring.close()
 
 
-def capture_frames(file_path, frames_dict, prefetched_samples, total_frames):
+def capture_frames(file_path, ring, free_slots, batches, done, gpu_batchsize, worker_nodes, frame_limit=-1,
+                   inference_size=320, info=None):
     print(F"WORKER FRAMERIPPER ONLINE")
-    for idx, frame in enumerate(iter_frames(file_path)):
-        frames_dict[idx] = frame
-        while len(frames_dict) > prefetched_samples:
-            time.sleep(0.1)
-        if idx > total_frames:
-            break
+    source = None
+    try:
+        source = FrameSource(file_path, inference_size, info=info)
+        start = count = 0
+        # reads until the end of the video, the writer learns the count from the "end" message
+        for idx in itertools.count() if frame_limit == -1 else range(frame_limit):
+            # blocks while the ring is full, until the writer frees the oldest slot
+            free_slots.acquire()
+            # ffmpeg's output goes straight into the frame's slot
+            if source.read(ring.frames[ring.slot(idx)]) is None:
+                break
+            count += 1
+            if count == gpu_batchsize:
+                batches.put((start, count))
+                start, count = start + count, 0
+        if count:
+            batches.put((start, count))
+        if not start + count:
+            raise Exception("Could not read any frames from video")
+        done.put(("end", start + count))
+    except Exception:
+        done.put(("error", "frame ripper", traceback.format_exc()))
+    finally:
+        if source is not None:
+            source.close()
+        for _ in range(worker_nodes):
+            batches.put(None)
+        ring.close()
+
+
+def _next_message(done, processes):
+    # messages arrive as soon as a stage has something; the timeout only
+    # catches processes that died without a word (killed, out of memory)
+    while True:
+        try:
+            return done.get(timeout=1)
+        except queue.Empty:
+            for process in processes:
+                if process.exitcode not in (None, 0):
+                    raise RuntimeError(F"Video worker process crashed (exit code {process.exitcode}). "
+                                       F"Try reducing worker count with -wn 1") from None
 
 
 def matte_key(output, file_path,
@@ -105,37 +151,17 @@ def matte_key(output, file_path,
               model_name,
               frame_limit=-1,
               prefetched_batches=4,
-              framerate=-1):
-    manager = multiprocessing.Manager()
-
-    results_dict = manager.dict()
-    frames_dict = manager.dict()
-
-
-    info = ffmpeg.probe(file_path)
-    cmd = [
-        "ffprobe",
-        "-v",
-        "error",
-        "-select_streams",
-        "v:0",
-        "-count_packets",
-        "-show_entries",
-        "stream=nb_read_packets",
-        "-of",
-        "csv=p=0",
-        file_path
-    ]
-    framerate_output = sp.check_output(cmd, universal_newlines=True)
-
-    total_frames = int(framerate_output.split(",")[0])
-    if frame_limit != -1:
+              framerate=-1,
+              inference_size=320,
+              quantize=None,
+              backend="torch"):
+    # one probe of the container's headers; the frames are only counted as they are decoded
+    source = FrameSource(file_path, inference_size, info=ffmpeg.probe(file_path))
+    video_stream = source.stream
+    total_frames = source.expected_frames()
+    if frame_limit != -1 and total_frames is not None:
         total_frames = min(frame_limit, total_frames)
 
-    video_stream = next((s for s in info["streams"] if s["codec_type"] == "video"), None)
-    if not video_stream:
-        raise Exception("Could not find video stream")
-
     frame_rate_str = video_stream.get("r_frame_rate", "0/0")
     if frame_rate_str == "0/0":
         raise Exception("Could not detect framerate of video")
@@ -148,89 +174,103 @@ def matte_key(output, file_path,
         framerate_str = str(framerate)
         framerate_value = float(framerate)
 
-    print(F"FRAME RATE: {framerate_value} TOTAL FRAMES: {total_frames}")
+    print(F"FRAME RATE: {framerate_value} TOTAL FRAMES: {'unknown' if total_frames is None else total_frames}")
+
+    # room for the prefetched batches plus the batch every worker is on,
+    # so the ripper never waits on a frame a worker still needs
+    slots = gpu_batchsize * (prefetched_batches + worker_nodes)
+    ring = FrameRing(slots, source.shape)
+    # the ripper takes a slot per frame and the writer gives it back once
+    # the mask is written, which bounds the prefetch
+    free_slots = multiprocessing.Semaphore(slots)
+    batches = multiprocessing.Queue()
+    done = multiprocessing.Queue()
 
     p = multiprocessing.Process(target=capture_frames,
-                                args=(file_path, frames_dict, gpu_batchsize * prefetched_batches, total_frames))
+                                args=(file_path, ring, free_slots, batches, done, gpu_batchsize, worker_nodes,
+                                      frame_limit, inference_size, source.info))
     p.start()
 
+    # load the weights once here and hand the workers views of them, rather
+    # than every worker loading its own copy
+    weights = None
+    if backend == "torch" and not quantize and inference_device().type in optimize.SHAREABLE_DEVICES:
+        engine = registry.get_model(model_name, device=inference_device())
+        weights = optimize.share_weights(engine)
+    elif quantize and backend == "torch":
+        # quantize (and cache) once here, so the workers load the cached int8
+        # model instead of each calibrating their own
+        registry.get_model(model_name, dtype="int8")
+    elif backend == "onnx":
+        # likewise export once, rather than every worker racing to write the same file
+        backends.ensure_onnx(model_name)
+
     # note I am deliberately not using pool
     # we can't trust it to run all the threads concurrently (or at all)
     workers = [multiprocessing.Process(target=worker,
-                                       args=(worker_nodes, wn, results_dict, model_name, gpu_batchsize, total_frames,
-                                             frames_dict))
+                                       args=(wn, ring, batches, done, model_name, inference_size, quantize, backend,
+                                             weights))
                for wn in range(worker_nodes)]
     for w in workers:
         w.start()
 
     command = None
     proc = None
+    frame = None
+    # batches whose masks are done but not written yet, by first frame
+    finished = {}
     frame_counter = 0
-    for i in range(math.ceil(total_frames / worker_nodes)):
-        for wx in range(worker_nodes):
-
-            hash_index = i * worker_nodes + 1 + wx
-
-            try:
-                timeout_counter = 0
-                while hash_index not in results_dict:
-                    time.sleep(0.1)
-                    timeout_counter += 1
-                    # Check if workers are still alive every 10 seconds
-                    if timeout_counter % 100 == 0:
-                        dead_workers = [w for w in workers if not w.is_alive()]
-                        if dead_workers and hash_index not in results_dict:
-                            raise RuntimeError(f"Worker process crashed while waiting for frame batch {hash_index}. Try reducing worker count with -wn 1")
-
-                frames = results_dict[hash_index]
-            except (ConnectionResetError, BrokenPipeError) as e:
-                print(f"\nError: Worker connection lost (frame batch {hash_index}). This often happens with high worker counts.")
-                print("Try reducing workers with -wn 1 or -wn 2")
-                # Clean up
-                p.terminate()
-                for w in workers:
-                    w.terminate()
-                if proc:
-                    proc.stdin.close()
-                    proc.wait()
-                raise RuntimeError(f"Worker connection error: {e}")
-            # dont block access to it anymore
-            del results_dict[hash_index]
-
-            for frame in frames:
-                if command is None:
-                    command = ['ffmpeg',
-                               '-y',
-                               '-f', 'rawvideo',
-                               '-vcodec', 'rawvideo',
-                               '-s', F"{frame.shape[1]}x320",
-                               '-pix_fmt', 'gray',
-                               '-r', framerate_str,
-                               '-i', '-',
-                               '-an',
-                               '-vcodec', 'mpeg4',
-                               '-b:v', '2000k',
-                               '%s' % output]
-
-                    proc = sp.Popen(command, stdin=sp.PIPE)
-
-                proc.stdin.write(frame.tobytes())
-                frame_counter = frame_counter + 1
-
-                if frame_counter >= total_frames:
-                    p.join()
-                    for w in workers:
-                        w.join()
-                    proc.stdin.close()
-                    proc.wait()
-                    print(F"FINISHED ALL FRAMES ({total_frames})!")
-                    return
-
-    p.join()
-    for w in workers:
-        w.join()
-    proc.stdin.close()
-    proc.wait()
+    frames_read = None
+    try:
+        while frames_read is None or frame_counter < frames_read:
+            message = _next_message(done, [p] + workers)
+            if message[0] == "error":
+                raise RuntimeError(F"Video {message[1]} failed:\n{message[2]}")
+            if message[0] == "end":
+                frames_read = message[1]
+                continue
+            finished[message[1]] = message[2]
+
+            # write the masks in order as soon as the next batch is there
+            while frame_counter in finished:
+                for index in range(frame_counter, frame_counter + finished.pop(frame_counter)):
+                    frame = ring.masks[ring.slot(index)]
+                    if command is None:
+                        command = ['ffmpeg',
+                                   '-y',
+                                   '-f', 'rawvideo',
+                                   '-vcodec', 'rawvideo',
+                                   '-s', F"{frame.shape[1]}x{frame.shape[0]}",
+                                   '-pix_fmt', 'gray',
+                                   '-r', framerate_str,
+                                   '-i', '-',
+                                   '-an',
+                                   '-vcodec', 'mpeg4',
+                                   '-b:v', '2000k',
+                                   '%s' % output]
+
+                        proc = sp.Popen(command, stdin=sp.PIPE)
+
+                    proc.stdin.write(frame.data)
+                    # hand the slot back to the ripper
+                    free_slots.release()
+                    frame_counter += 1
+
+        p.join()
+        for w in workers:
+            w.join()
+    except BaseException:
+        p.terminate()
+        for w in workers:
+            w.terminate()
+        raise
+    finally:
+        if proc:
+            proc.stdin.close()
+            proc.wait()
+        frame = None  # a view into the ring, which has to go before it is closed
+        ring.close()
+    print(F"FINISHED ALL FRAMES ({frame_counter})!")
     return
 
 
@@ -240,7 +280,10 @@ def transparentgif(output, file_path,
                    model_name,
                    frame_limit=-1,
                    prefetched_batches=4,
-                   framerate=-1):
+                   framerate=-1,
+                   inference_size=320,
+                   quantize=None,
+                   backend="torch"):
     temp_dir = tempfile.TemporaryDirectory()
     tmpdirname = Path(temp_dir.name)
     temp_file = os.path.abspath(os.path.join(tmpdirname, "matte.mp4"))
@@ -250,7 +293,10 @@ def transparentgif(output, file_path,
               model_name,
               frame_limit,
               prefetched_batches,
-              framerate)
+              framerate,
+              inference_size,
+              quantize,
+              backend)
     cmd = [
         'ffmpeg', '-y', '-i', file_path, '-i', temp_file, '-filter_complex',
         '[1][0]scale2ref[mask][main];[main][mask]alphamerge,fps=10,split[s0][s1];[s0]palettegen[p];[s1][p]paletteuse',
@@ -270,7 +316,10 @@ def transparentgifwithbackground(output, overlay, file_path,
                       model_name,
                       frame_limit=-1,
                       prefetched_batches=4,
-                      framerate=-1):
+                      framerate=-1,
+                      inference_size=320,
+                      quantize=None,
+                      backend="torch"):
     temp_dir = tempfile.TemporaryDirectory()
     tmpdirname = Path(temp_dir.name)
     temp_file = os.path.abspath(os.path.join(tmpdirname, "matte.mp4"))
@@ -280,7 +329,10 @@ def transparentgifwithbackground(output, overlay, file_path,
               model_name,
               frame_limit,
               prefetched_batches,
-              framerate)
+              framerate,
+              inference_size,
+              quantize,
+              backend)
     print("Starting alphamerge")
     cmd = [
         'ffmpeg', '-y', '-i', file_path, '-i', temp_file, '-i', overlay, '-filter_complex',
@@ -304,7 +356,10 @@ def transparentvideo(output, file_path,
                      prefetched_batches=4,
                      framerate=-1,
                      alpha_codec="auto",
-                     alpha_pix_fmt=None):
+                     alpha_pix_fmt=None,
+                     inference_size=320,
+                     quantize=None,
+                     backend="torch"):
     temp_dir = tempfile.TemporaryDirectory()
     tmpdirname = Path(temp_dir.name)
     temp_file = os.path.abspath(os.path.join(tmpdirname, "matte.mp4"))
@@ -314,7 +369,10 @@ def transparentvideo(output, file_path,
               model_name,
               frame_limit,
               prefetched_batches,
-              framerate)
+              framerate,
+              inference_size,
+              quantize,
+              backend)
     print("Starting alphamerge")
     encoding_args = _alpha_encoding_args(output, alpha_codec, alpha_pix_fmt)
     cmd = [
@@ -341,7 +399,10 @@ def transparentvideoovervideo(output, overlay, file_path,
                          prefetched_batches=4,
                          framerate=-1,
                          alpha_codec="auto",
-                         alpha_pix_fmt=None):
+                         alpha_pix_fmt=None,
+                         inference_size=320,
+                         quantize=None,
+                         backend="torch"):
     temp_dir = tempfile.TemporaryDirectory()
     tmpdirname = Path(temp_dir.name)
     temp_file = os.path.abspath(os.path.join(tmpdirname, "matte.mp4"))
@@ -351,7 +412,10 @@ def transparentvideoovervideo(output, overlay, file_path,
               model_name,
               frame_limit,
               prefetched_batches,
-              framerate)
+              framerate,
+              inference_size,
+              quantize,
+              backend)
     print("Starting alphamerge")
     encoding_args = _alpha_encoding_args(output, alpha_codec, alpha_pix_fmt)
     cmd = [
@@ -377,7 +441,10 @@ def transparentvideooverimage(output, overlay, file_path,
                          prefetched_batches=4,
                          framerate=-1,
                          alpha_codec="auto",
-                         alpha_pix_fmt=None):
+                         alpha_pix_fmt=None,
+                         inference_size=320,
+                         quantize=None,
+                         backend="torch"):
     temp_dir = tempfile.TemporaryDirectory()
     tmpdirname = Path(temp_dir.name)
     temp_file = os.path.abspath(os.path.join(tmpdirname, "matte.mp4"))
@@ -387,7 +454,10 @@ def transparentvideooverimage(output, overlay, file_path,
               model_name,
               frame_limit,
               prefetched_batches,
-              framerate)
+              framerate,
+              inference_size,
+              quantize,
+              backend)
     print("Scale image")
     temp_image = os.path.abspath("%s/new.jpg" % tmpdirname)
     cmd = [